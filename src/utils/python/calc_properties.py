@@ -1,44 +1,269 @@
+import collections
 import itertools
-import json
+import os
 import sys
 import numpy as np
 
-obj = json.load(open(sys.argv[1]))
-
-def volume(data):
-    indices = np.array(data["faceVertexIndices"], dtype=int)
-    points = np.array(data["points"], dtype=float)
-    ref = points.mean(axis=0)
-    vol = 0.0
-    for i in range(0, len(indices), 3):
-        a = points[indices[i    ]] - ref
-        b = points[indices[i + 1]] - ref
-        c = points[indices[i + 2]] - ref
-        vol += np.dot(np.cross(a, b), c) / 6.0
-    return vol
-
-def height(data):
-    points = np.array(data["points"], dtype=float)
-    return points[:,2].max() - points[:,2].min()
-
-
-parents = dict(itertools.chain.from_iterable(([(c, o['path']) for k, c in o['children'].items() if k != 'Void'] for o in obj['data'] if o.get('children'))))
-
-for d in [d for d in list(obj['data']) if d.get('attributes', {}).get('usd::usdgeom::mesh')]:
-    mesh = d['attributes']['usd::usdgeom::mesh']
-    if (vol := volume(mesh)) > 0. and d['path'] in parents:
-        obj['data'].append({
-        "path": parents[d['path']],
-        "attributes": {
-            "bsi::ifc::v5a::prop::volume": vol,
-            "bsi::ifc::v5a::prop::height": height(mesh),
+import ifcx_stream
+from ifcx_document import IfcxDocument
+
+MESH = 'usd::usdgeom::mesh'
+XFORM = 'usd::xformop'
+PROP = 'bsi::ifc::v5a::prop::'
+
+
+def instances(doc):
+    """
+    The Body meshes of `doc` as instances, one per element placing the mesh,
+    as meshes can be shared by compact.py and merge_meshes.py and are passed
+    on by types to their occurrences: the paths, the mesh attributes, the
+    matrices to world coordinates and the elements owning them.
+    """
+    def attributes(path, seen=()):
+        # own attributes over those inherited
+        n = doc.compose(path)
+        if n is None or path in seen:
+            return {}
+        inherited = [attributes(p, seen + (path,)) for p in n['inherits'].values() if p]
+        return dict(itertools.chain(*(a.items() for a in inherited), n['attributes'].items()))
+
+    composed = {}
+    def attribute(path, name):
+        if path not in composed:
+            composed[path] = attributes(path)
+        return composed[path].get(name)
+
+    parents = {}
+    for p in doc.paths():
+        if ps := [q for q, k in doc.parents(p) if k != 'Void']:
+            parents[p] = ps[-1]
+
+    def matrix(path):
+        xform = (attribute(path, XFORM) or {}).get('transform')
+        return np.array(xform, dtype=float) if xform is not None else np.eye(4)
+
+    world = {}
+    def world_matrix(path):
+        """
+        Row-vector matrix from the coordinates of `path` to those of the
+        root, the transforms of its ancestors applied after its own.
+        """
+        if path not in world:
+            chain = []
+            p = path
+            while p is not None and p not in world and p not in chain:
+                chain.append(p)
+                p = parents.get(p)
+            m = world.get(p, np.eye(4))
+            for p in reversed(chain):
+                world[p] = m = matrix(p) @ m
+        return world[path]
+
+    def placements(path, name, seen=()):
+        # `path` where it is placed itself, and the occurrences inheriting its child `name`
+        inheritors = [q for q, k in doc.inheritors(path) if q not in seen]
+        if path in parents or not inheritors:
+            yield path
+        for q in inheritors:
+            if name not in doc.compose(q)['children']:
+                yield from placements(q, name, seen + (path,))
+
+    # (mesh, owner) in order, without repeats
+    pairs = {}
+    for p in doc.paths():
+        if (attribute(p, MESH) or {}).get('faceVertexIndices'):
+            for q, k in doc.parents(p):
+                if k == 'Body':
+                    pairs.update(((p, o), None) for o in placements(q, k))
+
+    # the transform of the mesh itself, then those of the owner and its ancestors
+    return (
+        [p for p, o in pairs],
+        [attribute(p, MESH) for p, o in pairs],
+        [matrix(p) @ world_matrix(o) for p, o in pairs],
+        [o for p, o in pairs]
+    )
+
+
+def quantities(meshes, matrices):
+    """
+    Per mesh in `meshes`, transformed by the corresponding matrix: the volume,
+    area, upward and downward projected area, minimum and maximum corner, and
+    the moments of the volume and of the area. The meshes are concatenated
+    with offsets and computed on at once.
+    """
+    points = [np.asarray(m['points'], dtype=float).reshape((-1, 3)) for m in meshes]
+    indices = [np.asarray(m['faceVertexIndices'], dtype=np.int64).reshape((-1, 3)) for m in meshes]
+    num_points = np.array([len(p) for p in points], dtype=np.int64)
+    num_tris = np.array([len(t) for t in indices], dtype=np.int64)
+    point_offsets = np.concatenate(([0], np.cumsum(num_points)[:-1])).astype(np.int64)
+
+    pid = np.repeat(np.arange(len(meshes)), num_points)
+    tid = np.repeat(np.arange(len(meshes)), num_tris)
+
+    # points in world coordinates, transformed per instance
+    W = np.asarray(matrices)[pid]
+    P = np.concatenate(points)
+    P = P[:, 0:1] * W[:, 0, :3] + P[:, 1:2] * W[:, 1, :3] + P[:, 2:3] * W[:, 2, :3] + W[:, 3, :3]
+    del W
+
+    T = np.concatenate(indices) + np.repeat(point_offsets, num_tris)[:, None]
+    a, b, c = P[T[:, 0]], P[T[:, 1]], P[T[:, 2]]
+
+    # signed volumes of the tetrahedra to the mean point of each mesh
+    ref = np.stack([np.bincount(pid, P[:, k], len(meshes)) for k in range(3)], axis=1) / num_points[:, None]
+    r = ref[tid]
+    vols = np.einsum('ij,ij->i', np.cross(a - r, b - r), c - r) / 6.0
+    normals = np.cross(b - a, c - a)
+    areas = np.linalg.norm(normals, axis=1) / 2.0
+
+    tet_centroids = (r + a + b + c) / 4.0
+    tri_centroids = (a + b + c) / 3.0
+    return {
+        'volume': np.bincount(tid, vols, len(meshes)),
+        'area': np.bincount(tid, areas, len(meshes)),
+        'up': np.bincount(tid, np.maximum(normals[:, 2], 0.), len(meshes)) / 2.0,
+        'down': np.bincount(tid, np.maximum(-normals[:, 2], 0.), len(meshes)) / 2.0,
+        'lo': np.minimum.reduceat(P, point_offsets),
+        'hi': np.maximum.reduceat(P, point_offsets),
+        'moment': np.stack([np.bincount(tid, vols * tet_centroids[:, k], len(meshes)) for k in range(3)], axis=1),
+        'area_moment': np.stack([np.bincount(tid, areas * tri_centroids[:, k], len(meshes)) for k in range(3)], axis=1),
+    }
+
+
+def properties(parents, q):
+    """
+    Yields the nodes with the properties of the elements that are the
+    `parents` of the instances, from the quantities() `q` of the instances
+    summed per element.
+    """
+    owners = sorted(set(parents))
+    owner_index = {p: i for i, p in enumerate(owners)}
+    instance_owner = np.array([owner_index[p] for p in parents], dtype=np.int64)
+
+    n = len(owners)
+    solid = q['volume'] > 0.
+    owner_volume = np.bincount(instance_owner, np.where(solid, q['volume'], 0.), n)
+    owner_area = np.bincount(instance_owner, q['area'], n)
+    # the projection of the upward or downward faces, as open meshes have one of them
+    owner_footprint = np.maximum(np.bincount(instance_owner, q['up'], n), np.bincount(instance_owner, q['down'], n))
+    owner_lo = np.full((n, 3), np.inf)
+    owner_hi = np.full((n, 3), -np.inf)
+    np.minimum.at(owner_lo, instance_owner, q['lo'])
+    np.maximum.at(owner_hi, instance_owner, q['hi'])
+    # of the volume of solids, or of the surface of other meshes
+    owner_moment = np.stack([np.bincount(instance_owner, np.where(solid, q['moment'][:, k], 0.), n) for k in range(3)], axis=1)
+    owner_area_moment = np.stack([np.bincount(instance_owner, q['area_moment'][:, k], n) for k in range(3)], axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        owner_centroid = np.where(
+            (owner_volume > 0.)[:, None],
+            owner_moment / owner_volume[:, None],
+            owner_area_moment / owner_area[:, None]
+        )
+
+    for i, path in enumerate(owners):
+        props = {}
+        if owner_volume[i] > 0.:
+            props[PROP + 'volume'] = float(owner_volume[i])
+        props[PROP + 'height'] = float(owner_hi[i, 2] - owner_lo[i, 2])
+        props[PROP + 'surfacearea'] = float(owner_area[i])
+        props[PROP + 'footprintarea'] = float(owner_footprint[i])
+        props[PROP + 'boundingboxmin'] = owner_lo[i].tolist()
+        props[PROP + 'boundingboxmax'] = owner_hi[i].tolist()
+        if np.isfinite(owner_centroid[i]).all():
+            props[PROP + 'centroid'] = owner_centroid[i].tolist()
+        yield {
+        "path": path,
+        "attributes": props
         }
-        })
 
-ostream = None
-try:
-    ostream = open(sys.argv[2], 'w')
-except: 
-    ostream = sys.stdout
 
-json.dump(obj, ostream, indent=2)
+def process(doc):
+    """
+    Adds the volume, height, areas, bounding box and centroid of the meshes
+    under each element of `doc` as its properties, in world coordinates.
+    """
+    paths, meshes, matrices, parents = instances(doc)
+    if paths:
+        doc.extend(properties(parents, quantities(meshes, matrices)))
+
+
+def outline(node, i):
+    # `node` with the attributes instances() needs, mesh data replaced by the index `i` of the node
+    attrs = node.get('attributes') or {}
+    node = {**node, 'attributes': {k: attrs[k] for k in (XFORM, MESH) if k in attrs}}
+    if mesh := attrs.get(MESH):
+        node['attributes'][MESH] = {'node': i, 'faceVertexIndices': bool(mesh.get('faceVertexIndices'))}
+    return node
+
+
+def stream(fn, ostream, batch_size=1 << 14):
+    """
+    Writes IFCX file `fn` with the properties process() adds to `ostream`,
+    reading the file twice a node at a time: first its structure without
+    mesh data, then the nodes to copy, of which the meshes are computed on
+    in batches of about `batch_size` points.
+    """
+    doc = IfcxDocument()
+    with open(fn) as f:
+        doc.extend(outline(node, i) for i, (k, node) in enumerate(ifcx_stream.read(f)) if k == 'data')
+    paths, meshes, matrices, parents = instances(doc)
+    del doc
+
+    # the instances of the mesh of each node
+    uses = collections.defaultdict(list)
+    for j, m in enumerate(meshes):
+        uses[m['node']].append(j)
+
+    # (instances, quantities) per batch
+    parts = []
+    def compute(batch):
+        if batch:
+            parts.append(([j for j, m in batch], quantities([m for j, m in batch], [matrices[j] for j, m in batch])))
+
+    with open(fn) as f, ifcx_stream.Writer(ostream) as w:
+        # members after the data are written after the nodes added
+        batch, size, trailing = [], 0, []
+        for i, (k, node) in enumerate(ifcx_stream.read(f)):
+            if k != 'data':
+                if w.num_nodes is None:
+                    w.write(k, node)
+                else:
+                    trailing.append((k, node))
+                continue
+            w.node(node)
+            for j in uses.get(i, ()):
+                batch.append((j, node['attributes'][MESH]))
+                size += len(node['attributes'][MESH]['points'])
+            if size >= batch_size:
+                compute(batch)
+                batch, size = [], 0
+        compute(batch)
+
+        if parts:
+            order = np.argsort(np.concatenate([js for js, q in parts]))
+            q = {k: np.concatenate([q[k] for js, q in parts])[order] for k in parts[0][1]}
+            for node in properties(parents, q):
+                w.node(node)
+        for k, v in trailing:
+            w.write(k, v)
+
+
+if __name__ == '__main__':
+    # in memory for a node at a time rather than for the whole file
+    streaming = bool(os.environ.get('IFCX_STREAM'))
+
+    if not streaming:
+        doc = IfcxDocument.load(sys.argv[1])
+        process(doc)
+
+    ostream = None
+    try:
+        ostream = open(sys.argv[2], 'w')
+    except:
+        ostream = sys.stdout
+
+    if streaming:
+        stream(sys.argv[1], ostream)
+    else:
+        doc.dump(ostream)
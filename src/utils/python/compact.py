@@ -1,49 +1,118 @@
 import collections
+import hashlib
 import json
-import sys, re
+import sys
 
-ifn, ofn = sys.argv[1:]
+from ifcx_document import IfcxDocument
 
-di = json.load(open(ifn))
-mapping = collections.defaultdict(list)
-grouping = collections.defaultdict(list)
 
+def refs(v):
+    # paths of the {"ref": ...} values in attribute value `v`
+    if isinstance(v, dict):
+        if isinstance(v.get('ref'), str):
+            yield v['ref'].split('/')[0]
+        for x in v.values():
+            yield from refs(x)
+    elif isinstance(v, list):
+        for x in v:
+            yield from refs(x)
 
-for N in (n for n in di['data'] if 'attributes' in n and not 'children' in n):
-    grouping[N['path']].extend(N['attributes'].items())
 
+def update(h, v):
+    # feeds value `v` to hash `h`, dict items in sorted order, other values
+    # such as the arrays of meshes as their json at once
+    if isinstance(v, dict):
+        h.update(b'{%d' % len(v))
+        for k in sorted(v):
+            update(h, k)
+            update(h, v[k])
+    elif isinstance(v, list) and dict in set(map(type, v)):
+        h.update(b'[%d' % len(v))
+        for x in v:
+            update(h, x)
+    else:
+        s = json.dumps(v, sort_keys=True).encode()
+        h.update(b'%d:%s' % (len(s), s))
 
-for k, v in grouping.items():
-    mapping[json.dumps(dict(sorted(v)))].append(k)
 
-print(*map(len, mapping.values()))
+def digest(doc, path, digests):
+    """
+    Content hash of the subtree at `path` in `doc`: its attributes and the
+    digests of its children and inherits, so that identical subtrees at
+    different paths hash the same. Computed bottom-up, on an explicit stack,
+    memoized in `digests`.
+    """
+    stack, pending = [(path, False)], set()
+    while stack:
+        p, expanded = stack.pop()
+        if p in digests:
+            continue
+        node = doc.compose(p)
+        refs = [r for k in ('children', 'inherits') for r in node[k].values() if r] if node else []
+        if not expanded:
+            pending.add(p)
+            stack.append((p, True))
+            # references back up the stack (cycles) are hashed by path below
+            stack.extend((r, False) for r in refs if r not in digests and r not in pending)
+            continue
+        h = hashlib.blake2b(digest_size=16)
+        if node:
+            for k in ('children', 'inherits'):
+                h.update(k.encode())
+                for name in sorted(node[k]):
+                    r = node[k][name]
+                    update(h, name)
+                    h.update(digests.get(r) or repr(r).encode())
+            update(h, node['attributes'])
+        else:
+            # not in this file, identified by path
+            update(h, p)
+        digests[p] = h.digest()
+        pending.discard(p)
+    return digests[path]
 
-mapping2 = {}
 
-for srcs in (vs for vs in mapping.values() if len(vs) > 1):
-    tgt, *srcs = srcs
-    for src in srcs:
-        if src != tgt:
-            mapping2[src] = tgt
+def process(doc):
+    """
+    Shares the referenced subtrees of `doc` with the same content, the later
+    ones are removed and references to them redirected to the first.
+    """
+    # paths referred to from attributes are kept as they are
+    pinned = {r for p in doc.paths() for r in refs(doc.compose(p)['attributes'])}
 
+    # referenced subtrees by content, in order of first occurrence
+    digests = {}
+    mapping = collections.defaultdict(list)
+    for p in doc.paths():
+        if doc.parents(p) or doc.inheritors(p):
+            mapping[digest(doc, p, digests)].append(p)
 
-print(*mapping2.keys())
+    print(*map(len, mapping.values()))
+
+    mapping2 = {}
+
+    for srcs in (vs for vs in mapping.values() if len(vs) > 1):
+        tgt, *srcs = srcs
+        for src in srcs:
+            if src != tgt and src not in pinned:
+                mapping2[src] = tgt
+
+    print(*mapping2.keys())
+
+    for src, tgt in mapping2.items():
+        # the children and inherits referring to src are looked up in the index
+        for node, k, name in doc.referrers(src):
+            with doc.modify(node):
+                node[k][name] = tgt
+        doc.remove_path(src)
 
-def transform(node):
-    if 'children' in node:
-        return {
-            **node,
-            **{"children": {n:mapping2.get(c, c) for n, c in node['children'].items()}}
-        }
-    elif node['path'] in mapping2:
-        return None
-    else:
-        return node
 
-di['data'] = list(filter(None, map(transform, di['data'])))
+if __name__ == '__main__':
+    ifn, ofn = sys.argv[1:]
 
-s = json.dumps(di, indent=2)
-s = re.sub('\n\s+([\-\+\d\.e]+|\])(,?)(?=\n)', '\\1\\2', s)
+    doc = IfcxDocument.load(ifn)
+    process(doc)
 
-with open(ofn, 'w') as f:
-    print(s, file=f)
+    with open(ofn, 'w') as f:
+        doc.dump(f, compact=True)
+        f.write('\n')
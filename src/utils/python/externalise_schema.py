@@ -1,10 +1,20 @@
+import contextlib
+import hashlib
 import json
 import os
 import shutil
 import sys
+import tempfile
 
-obj = json.load(open(sys.argv[1]))
-obj["imports"] = []
+import ifcx_json
+from ifcx_document import IfcxDocument
+
+try:
+    import fcntl
+except ImportError:
+    # on Windows, locked with msvcrt instead
+    fcntl = None
+    import msvcrt
 
 prefix = 'https://ifcx.dev'
 
@@ -15,41 +25,93 @@ mapping = {
     'nlsfb': '@nlsfb/nlsfb@v1.ifcx'
 }
 
-def w(path, name, schema):
+@contextlib.contextmanager
+def locked(path):
+    # exclusive to one process at a time, by a lock on a file in the temp
+    # directory rather than next to `path`, which is in the published tree
+    name = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()
+    with open(os.path.join(tempfile.gettempdir(), f'ifcx-schema-{name}.lock'), 'w') as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+            return
+        # the first byte, LK_LOCK gives up after 10 attempts a second apart
+        while True:
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                break
+            except OSError:
+                pass
+        try:
+            yield
+        finally:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def w(path, schemas):
+    """
+    Adds `schemas` to the schema file `path`, except those it already has.
+    The file is replaced at once, and only when its content changes, under
+    a lock so that runs for other models can write to it at the same time.
+    """
     os.makedirs(os.path.dirname(path), exist_ok=True)
+    with locked(path):
+        try:
+            with open(path, 'r') as f:
+                old = f.read()
+            data = json.loads(old)
+        except (OSError, ValueError):
+            old = None
+            data = {
+                "header": {
+                    "version": "ifcx_alpha",
+                    "author": "authorname",
+                    "timestamp": "time string"
+                },
+                "schemas": {}
+            }
+        for name, schema in schemas.items():
+            data.setdefault('schemas', {}).setdefault(name, schema)
+        new = ifcx_json.dumps(data)
+        if new == old:
+            return
+        tmp = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                f.write(new)
+            os.replace(tmp, path)
+        finally:
+            # left over only when writing or replacing failed
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp)
+
+
+def process(doc, web='../../../web/'):
+    """
+    Moves the schemas of `doc` with a known prefix to the shared schema files
+    under `web`, and imports those instead. Each file is written once.
+    """
+    files = {}
+    for k, v in list(doc.schemas.items()):
+        for m, n in mapping.items():
+            if k.startswith(m):
+                files.setdefault(n, {})[k] = v
+                del doc.schemas[k]
+                break
+    for n, schemas in files.items():
+        w(web + n, schemas)
+    doc.obj["imports"] = [{"uri": f'{prefix}/{n}'} for n in files]
+
+
+if __name__ == '__main__':
+    doc = IfcxDocument.load(sys.argv[1])
+    process(doc)
+
+    ostream = None
     try:
-        with open(path, 'r') as f:
-            data = json.load(f)
-    except:
-        data = {
-            "header": {
-                "version": "ifcx_alpha",
-                "author": "authorname",
-                "timestamp": "time string"
-            },
-            "schemas": {}
-        }
-    if name not in data['schemas']:
-        data['schemas'][name] = schema
-    with open(path, 'w') as f:
-        json.dump(data, f, indent=2)
-
-for k, v in list(obj["schemas"].items()):
-    for m, n in mapping.items():
-        if k.startswith(m):
-            w('../../../web/' + n, k, v)
-            del obj["schemas"][k]
-            if m not in (x['uri'] for x in obj["imports"]):
-                obj["imports"].append({
-                    "uri": f'{prefix}/{n}'
-                })
-            break
-
-
-ostream = None
-try:
-    ostream = open(sys.argv[2], 'w')
-except: 
-    ostream = sys.stdout
+        ostream = open(sys.argv[2], 'w')
+    except: 
+        ostream = sys.stdout
 
-json.dump(obj, ostream, indent=2)
+    doc.dump(ostream)
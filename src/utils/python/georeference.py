@@ -0,0 +1,51 @@
+import functools
+
+import numpy as np
+
+
+@functools.lru_cache(maxsize=None)
+def transformer(source, target):
+    # creating a transformer is far more expensive than using it
+    from pyproj import Transformer
+    return Transformer.from_crs(source, target)
+
+
+class Georeference:
+    """
+    The IfcMapConversion of a model, applied to arrays of local points at once.
+    """
+
+    def __init__(self, mapc):
+        self.crs = mapc.TargetCRS.Name
+        self.vertical_datum = mapc.TargetCRS.VerticalDatum
+
+        the = np.arctan2(mapc.XAxisAbscissa, mapc.XAxisOrdinate)
+        scm = np.zeros((3, 3))
+        np.fill_diagonal(scm, mapc.Scale or 1)
+        rot = np.array([
+            [np.cos(the), -np.sin(the), 0],
+            [np.sin(the), -np.cos(the), 0],
+            [0,0,1]
+        ])
+        self.matrix = rot @ scm
+        self.offset = np.array((mapc.Eastings, mapc.Northings, mapc.OrthogonalHeight))
+
+    @staticmethod
+    def from_file(f):
+        if mapc := f.by_type('IfcMapConversion'):
+            return Georeference(mapc[0])
+
+    def to_map(self, xyz):
+        """
+        Local (n, 3) coordinates to (n, 3) eastings, northings and height.
+        """
+        xyz = np.asarray(xyz, dtype=float).reshape((-1, 3))
+        return np.einsum('ij,nj->ni', self.matrix, xyz) + self.offset
+
+    def to_latlon(self, enh, crs='EPSG:4326'):
+        """
+        (n, 3) eastings, northings and height to (n, 2) latitude and longitude.
+        """
+        enh = np.asarray(enh, dtype=float).reshape((-1, 3))
+        lat, lon = transformer(self.crs, crs).transform(*enh.T)[0:2]
+        return np.column_stack((lat, lon))
@@ -3,46 +3,51 @@ import itertools
 import json
 import os
 import re
-import shutil
-import subprocess
 import sys
+import time
 import pyvista as pv
                     
 import ifcopenshell
 import ifcopenshell.geom
 import ifcopenshell.guid
+import ifcopenshell.util.element
 import numpy as np
 
-S = ifcopenshell.geom.settings(WELD_VERTICES=False, DIMENSIONALITY=2)
+import georeference
+import tessellation
+import usd_schema
 
-USD_HOME = os.environ['USD_HOME']
-sys.path.extend((rf'{USD_HOME}\lib\python', rf'{USD_HOME}\pip-packages'))
-os.environ['PATH'] += ''.join(map(lambda s: f';{s}', map(os.path.abspath, (rf'{USD_HOME}\bin', rf'{USD_HOME}\plugin\usd', rf'{USD_HOME}\lib'))))
-os.environ['PLUG_INFO_LIBRARY_PATH'] = os.path.abspath('schema/ifc5')
-os.environ['PLUG_INFO_RESOURCE_PATH'] = os.path.abspath('schema/ifc5')
+S = ifcopenshell.geom.settings(WELD_VERTICES=False, DIMENSIONALITY=2)
 
-subprocess.call([rf'{USD_HOME}\scripts\usdGenSchema.bat', 'schema.usd'], cwd='schema/ifc5', shell=True)
+# with the previous .ifc and .ifcx as additional arguments, only an overlay
+# .ifcx with the changes to the previous conversion is written
+fn, ofn, *previous = sys.argv[1:]
 
-with open('schema/ifc5/plugInfo.2.json', 'w') as g:
-    with open('schema/ifc5/plugInfo.json', 'r') as f:
-        for i in range(3):
-            g.write(f.readline())
-        d = json.load(f)
-        d['Plugins'][0]['LibraryPath'] = os.path.abspath('schema/ifc5')
-        d['Plugins'][0]['ResourcePath'] = os.path.abspath('schema/ifc5')
-        json.dump(d, g, indent=4)
+# an .ifcx output file is written directly, without going through USD
+WRITE_IFCX = ofn.endswith('.ifcx')
 
-shutil.move('schema/ifc5/plugInfo.2.json', 'schema/ifc5/plugInfo.json')
+if not WRITE_IFCX:
+    USD_HOME = os.environ['USD_HOME']
+    sys.path.extend((rf'{USD_HOME}\lib\python', rf'{USD_HOME}\pip-packages'))
+    os.environ['PATH'] += ''.join(map(lambda s: f';{s}', map(os.path.abspath, (rf'{USD_HOME}\bin', rf'{USD_HOME}\plugin\usd', rf'{USD_HOME}\lib'))))
 
-existing_paths = os.getenv('PXR_PLUGINPATH_NAME', '')
-os.environ['PXR_PLUGINPATH_NAME'] = os.pathsep.join((os.path.abspath('schema/ifc5'), existing_paths))
+    # only runs usdGenSchema when schema.usd changed
+    plugin_dir = usd_schema.build_plugin(USD_HOME, 'schema/ifc5')
+    os.environ['PLUG_INFO_LIBRARY_PATH'] = plugin_dir
+    os.environ['PLUG_INFO_RESOURCE_PATH'] = plugin_dir
 
-from pxr import Usd, UsdGeom, Vt, Gf, Sdf, UsdShade
+    existing_paths = os.getenv('PXR_PLUGINPATH_NAME', '')
+    os.environ['PXR_PLUGINPATH_NAME'] = os.pathsep.join((plugin_dir, existing_paths))
 
-fn, ofn = sys.argv[1:]
+    from usd_writer import UsdWriter as Writer
+else:
+    from ifcx_writer import IfcxWriter as Writer
 
 f = ifcopenshell.open(fn)
 
+# IfcMapConversion, if any, read once
+georef = georeference.Georeference.from_file(f)
+
 if os.path.basename(fn) == 'linear-placement-of-signal.ifc':
     # remove footprint representation
     f.remove(f[2697])
@@ -116,8 +121,16 @@ if os.path.basename(fn).startswith("bonsai-wall"):
     )
     pset.DefinesOccurrence[0].RelatedObjects = f.by_type('IfcBuildingElement')
 
-stage = Usd.Stage.CreateNew(ofn)
-UsdGeom.SetStageUpAxis(stage, UsdGeom.Tokens.z)
+# GlobalIds of the elements to write, all when None
+dirty = None
+
+if previous:
+    import ifcx_overlay
+    f0 = ifcopenshell.open(previous[0])
+    dirty = ifcx_overlay.dirty_elements(f0, f)
+    writer = ifcx_overlay.OverlayWriter(ofn, json.load(open(previous[1])), dirty, [el.GlobalId for el in f0.by_type('IfcRoot')])
+else:
+    writer = Writer(ofn)
 
 # relationships to follow to build placement tree
 inverses = [
@@ -156,61 +169,93 @@ def get_name(el):
 
 
 # Write converted placement as USD xform
-def write_placement(pl, prim):
+def write_placement(pl, path):
     M4 = ifcopenshell.ifcopenshell_wrapper.map_shape(S, pl.wrapped_data)
     if not M4.is_identity():
-        UsdGeom.Xform(prim).AddTransformOp().Set(Gf.Matrix4d((np.array(M4.components).T)))
+        writer.set_transform(path, np.array(M4.components).T)
 
 # Tesselate geometries
 geometries = {}
 object_to_geom = collections.defaultdict(list)
 
-for geom in ifcopenshell.geom.iterate(S, f):
-    vs = np.array(geom.geometry.verts).reshape((-1, 3))
-    idxs = np.array(geom.geometry.faces).reshape((-1, 3))
-    eds = np.array(geom.geometry.edges).reshape((-1, 2))
-
-    if geom.context == 'Body' and ((vs[:,2].max() - vs[:,2].min()) < 1.e-5):
+# @nb with IFCX_GEOMETRY_STORE set, arrays are memory-mapped views on a
+# temporary file in that directory, rather than held in memory
+cache = tessellation.Cache.from_environ(f, S)
+store = tessellation.Store.from_environ()
+
+products = None
+if dirty is not None:
+    # types are written with the geometry of their first occurrence, and
+    # shared geometry is detected among the occurrences of a type
+    products = set()
+    for g in dirty:
+        try:
+            el = f.by_guid(g)
+        except RuntimeError:
+            continue
+        if el.is_a('IfcProduct'):
+            products.add(el)
+            el = ifcopenshell.util.element.get_type(el)
+        if el and el.is_a('IfcTypeObject'):
+            products.update(ifcopenshell.util.element.get_types(el))
+    products.update([rel.RelatingOpeningElement for el in list(products) for rel in getattr(el, 'FillsVoids', ())])
+
+for el, ctx, gid, vs, idxs, eds in tessellation.tessellate(f, S, cache=cache, store=store, products=products):
+    if ctx == 'Body' and ((vs[:,2].max() - vs[:,2].min()) < 1.e-5):
         continue
     
-    geometries[geom.geometry.id] = (geom.context, vs, idxs, eds)
-    object_to_geom[f[geom.id]].append(geom.geometry.id)
+    geometries[gid] = (ctx, vs, idxs, eds)
+    object_to_geom[el].append(gid)
 
 shared_geometries = set(k for k, v in collections.Counter(itertools.chain.from_iterable(object_to_geom.values())).items() if v > 1)
 
-def write_geom_2(xf, ctx, vs, idxs, eds, override=None):
-    path1 = xf.GetPath().pathString + f"/{ctx}"
-    path2 = "/" + xf.GetPath().pathString.split('/')[-1] + f"_{ctx}"
+# instance geometry by content: 'content' for identical arrays, 'local' to
+# also share geometry that only differs by a translation
+GEOMETRY_INSTANCING = os.environ.get('IFCX_GEOMETRY_INSTANCING', '')
 
+# class prims emitted for unique geometry content
+instances = set()
+
+def write_geom_class(path, vs, idxs, eds, override=None):
     if idxs.size:
-        # mesh = UsdGeom.Mesh.Define(stage, path2)
-        prim = stage.CreateClassPrim(path2)
-        prim.SetTypeName("Mesh")
-        mesh = UsdGeom.Mesh(prim)
-        mesh.GetPointsAttr().Set(Vt.Vec3fArray(vs.tolist()))
-        mesh.GetFaceVertexIndicesAttr().Set(Vt.IntArray(idxs.flatten().tolist()))
-        mesh.GetFaceVertexCountsAttr().Set(Vt.IntArray([3] * len(idxs)))
+        writer.define_class(path, "Mesh")
+        writer.set_mesh(path, vs, idxs)
     else:
         vs2, mapping = np.unique(vs, axis=0, return_inverse=True)
         mm = mapping[eds].flatten()
         mmm = mm[np.concatenate((np.diff(mm) != 0, (True,)))]
 
-        # line = UsdGeom.BasisCurves.Define(stage, path2)
-        prim = stage.CreateClassPrim(path2)
-        prim.SetTypeName("BasisCurves")
-        line = UsdGeom.BasisCurves(prim)
-        line.GetPointsAttr().Set(Vt.Vec3fArray(vs2[mmm].tolist()))
-        line.GetCurveVertexCountsAttr().Set(Vt.IntArray([len(mmm)]))
-        line.GetTypeAttr().Set(UsdGeom.Tokens.linear)
-        line.GetWidthsAttr().Set(Vt.FloatArray([0.01] * len(mmm)))
+        writer.define_class(path, "BasisCurves")
+        writer.set_curves(path, vs2[mmm], [len(mmm)])
+
+    if override == "Void":
+        writer.set_invisible(path)
+
+def write_geom_2(xf, ctx, vs, idxs, eds, override=None):
+    path1 = xf + f"/{ctx}"
+    path2 = "/" + xf.split('/')[-1] + f"_{ctx}"
+
+    if GEOMETRY_INSTANCING:
+        digest, offset = tessellation.mesh_hash(vs, idxs, eds, local=GEOMETRY_INSTANCING == 'local')
+        # ctx is part of the name, so that a shared Void class is never visible
+        shared = f"/G{digest}_{ctx}"
+        if shared not in instances:
+            write_geom_class(shared, vs if offset is None else vs - offset, idxs, eds, override)
+            instances.add(shared)
+        if offset is not None and offset.any():
+            M4 = np.eye(4)
+            M4[3, 0:3] = offset
+            writer.define_class(path2, "Mesh" if idxs.size else "BasisCurves")
+            writer.set_transform(path2, M4)
+            writer.add_inherit(path2, shared)
+        else:
+            path2 = shared
+    else:
+        write_geom_class(path2, vs, idxs, eds, override)
 
     # mesh / line is the classdef in global namespace,
     # ref below is the concrete instantiation within the parent
-    ref = getattr(UsdGeom, "Mesh" if idxs.size else "BasisCurves").Define(stage, path1)
-    ref.GetPrim().GetInherits().AddInherit(path2)
-
-    if override == "Void":
-        UsdGeom.Imageable(prim).GetVisibilityAttr().Set('invisible')
+    writer.define(path1, "Mesh" if idxs.size else "BasisCurves", inherits=[path2])
 
 def write_geom(el, xf, override=None, istype=False):
     for gid in object_to_geom[el]:
@@ -228,15 +273,15 @@ types = collections.defaultdict(list)
 
 def getSdfType(v):
     if isinstance(v, tuple) and set(map(type, v)) == {float}:
-        return Sdf.ValueTypeNames.Point3d
+        return 'Point3d'
     elif isinstance(v, float):
-        return Sdf.ValueTypeNames.Float
+        return 'Float'
     elif isinstance(v, str):
-        return Sdf.ValueTypeNames.String
+        return 'String'
     elif isinstance(v, bool):
-        return Sdf.ValueTypeNames.Bool
+        return 'Bool'
     elif isinstance(v, int):
-        return Sdf.ValueTypeNames.Int
+        return 'Int'
     else:
         breakpoint()
 
@@ -248,9 +293,157 @@ def fmt_guid(g):
 
 created_nodes = {}
 
-# traverse from project
-def process(el, path=(), parentPath=None, asclass=False):
-    if os.path.basename(fn) == 'domestic-hot-water.ifc' and el.is_a('IfcWall'):
+# handlers per IFC class, applied in order of registration to every element
+# that is an instance of the class, with the element and its prim path
+handlers = []
+
+def handler(ifc_class, exclude=None):
+    def register(fn):
+        handlers.append((ifc_class, exclude, fn))
+        return fn
+    return register
+
+handlers_by_class = {}
+
+def dispatch(el):
+    ty = el.is_a()
+    if ty not in handlers_by_class:
+        handlers_by_class[ty] = [fn for c, x, fn in handlers if el.is_a(c) and not (x and el.is_a(x))]
+    return handlers_by_class[ty]
+
+@handler('IfcRoot', exclude='IfcPropertySet')
+def write_class(el, xf):
+    writer.set_attribute(xf, 'ifc5:class:uri', 'String', f'https://identifier.buildingsmart.org/uri/buildingsmart/ifc/4.3/class/{el.is_a().replace("Type", "")}')
+    writer.set_attribute(xf, 'ifc5:class:code', 'String', el.is_a().replace("Type", ""))
+
+@handler('IfcWall')
+def write_nlsfb_class(el, xf):
+    writer.set_attribute(xf, 'nlsfb:class:uri', 'String', f'https://identifier.buildingsmart.org/uri/nlsfb/nlsfb2005/2.2/class/21.21')
+    writer.set_attribute(xf, 'nlsfb:class:code', 'String', '21.21')
+
+@handler('IfcProduct')
+def write_object_placement(el, xf):
+    if el.ObjectPlacement:
+        write_placement(el.ObjectPlacement.RelativePlacement, xf)
+
+@handler('IfcDistributionPort')
+def write_flow_direction(el, xf):
+    if fd := el.FlowDirection:
+        writer.set_attribute(xf, 'ifc5:system:flowDirection', 'String', fd)
+
+@handler('IfcProduct')
+def write_product_geom(el, xf):
+    if el in object_to_geom:
+        write_geom(el, xf)
+
+@handler('IfcElement')
+def write_void_geom(el, xf):
+    if el.FillsVoids:
+        write_geom(el.FillsVoids[0].RelatingOpeningElement, xf, override='Void')
+        write_placement(el.FillsVoids[0].RelatingOpeningElement.ObjectPlacement.RelativePlacement, xf)
+
+@handler('IfcRoot')
+def write_types(el, xf):
+    for ty in types.get(el, ()):
+        writer.add_inherit(xf, ty)
+
+@handler('IfcProduct')
+def write_body_representation(el, xf):
+    if not el.Representation:
+        return
+    for r in [r for r in el.Representation.Representations if r.RepresentationIdentifier == 'Body']:
+        if os.path.basename(fn) == 'georeferenced-bridge-deck.ifc':
+            shp = ifcopenshell.geom.create_shape(ifcopenshell.geom.settings(USE_WORLD_COORDS=True), el)
+            xs,ys,zs = np.array(shp.geometry.verts).reshape((-1, 3)).T
+
+            # reference points at both ends of the deck, converted at once
+            xyz = np.array([(x, 0., zs.min()) for x in (xs.min(), xs.max())])
+            enh = georef.to_map(xyz)
+            latlon = georef.to_latlon(enh)
+
+            crs2d = georef.crs.lower().replace(":", "")
+            crsh = georef.vertical_datum.lower().replace(":", "")
+
+            for i, ((e, n, h), (lat, lon)) in enumerate(zip(enh.tolist(), latlon.tolist())):
+                prim = f"/refpoint{i}"
+                writer.define_class(prim, "Points")
+                writer.set_points(prim, np.zeros((1, 3)))
+                writer.define(xf + f"/ReferencePoint{i}", "Points", inherits=[prim])
+
+                M4 = np.eye(4)
+                M4[0:2,3] = xyz[i][0:2]
+
+                writer.set_transform(prim, M4.T)
+
+                writer.set_attribute(prim, f'{crs2d}:eastings', 'Double', e)
+                writer.set_attribute(prim, f'{crs2d}:northings', 'Double', n)
+                writer.set_attribute(prim, f'{crsh}:height', 'Double', h)
+                writer.set_attribute(prim, f'epsg4326:latitude', 'Double', lat)
+                writer.set_attribute(prim, f'epsg4326:longitude', 'Double', lon)
+
+        if r.Items[0].is_a('IfcExtrudedAreaSolid') and os.path.basename(fn) == 'bonsai-wall.ifc':
+            B = ifcopenshell.ifcopenshell_wrapper.map_shape(ifcopenshell.geom.settings(), r.Items[0].wrapped_data)
+            V = np.array(B.direction.components) * B.depth
+            # @nb does not work for trimmed curves like this
+            Ps = np.array([e.start.components for e in B.basis[0].children])
+
+            line_points = np.array([
+                Ps.min(axis=0),
+                Ps.min(axis=0) + V
+            ])
+
+            prim = xf + "_Directrix"
+            writer.define_class(prim, "BasisCurves")
+            writer.set_curves(prim, line_points, [2])
+            writer.define(xf + "/Directrix", "BasisCurves", inherits=[prim])
+
+            prim = xf + "_Basis"
+            writer.define_class(prim, "Mesh")
+
+            # triangulate basis
+            pd = pv.PolyData(Ps, [len(Ps), *range(len(Ps))]).triangulate()
+            writer.set_mesh(prim, np.asarray(pd.points), pd.faces.reshape((-1, 4))[:,1:])
+            writer.define(xf + "/Basis", "Mesh", inherits=[prim])
+
+@handler('IfcAlignmentSegment')
+def write_design_parameters(el, xf):
+    args = el.DesignParameters.get_info(recursive=True, include_identifier=False)
+    args.pop('type')
+    for k, v in args.items():
+        if v is not None:
+            if isinstance(v, dict):
+                v.pop('type')
+                v = next(iter(v.values()))
+            writer.set_attribute(xf, f'ifc5:{el.DesignParameters.is_a()[3:]}:{k}', getSdfType(v),
+                (v + (0.,)) if isinstance(v, tuple) and set(map(type, v)) == {float} else v
+            )
+
+# optional callbacks, IFCX_PROGRESS=n reports every n elements and the time
+# spent per handler
+PROGRESS = int(os.environ.get('IFCX_PROGRESS') or 0)
+
+on_element = None # (number of elements, element)
+on_handler = None # (handler, seconds)
+
+if PROGRESS:
+    t0 = time.perf_counter()
+    handler_times = collections.Counter()
+
+    def on_element(n, el):
+        if n % PROGRESS == 0:
+            print(f'{n} elements in {time.perf_counter() - t0:.1f}s, at {el}')
+
+    def on_handler(handle, elapsed):
+        handler_times[handle.__name__] += elapsed
+
+SKIP_WALLS = os.path.basename(fn) == 'domestic-hot-water.ifc'
+
+def visit(el, path, parentPath, asclass):
+    """
+    Writes the prim for `el`. Yields the arguments for visiting every child
+    along `inverses` and receives the path of the prim written for it.
+    """
+    if SKIP_WALLS and el.is_a('IfcWall'):
         return
 
     if el in visited:
@@ -263,152 +456,36 @@ def process(el, path=(), parentPath=None, asclass=False):
     if el.is_a('IfcOpeningElement'):
         pass
     else:
-        print(' '*len(path), el)
         path = path + (get_name(el),)
         path_str = "/" + "/".join(path)
         
         if FLATTEN_TREE:
             path_str = f"/{fmt_guid(el.GlobalId)}"
 
-        if asclass:
-            xf = stage.CreateClassPrim(Sdf.Path(path_str))
-            xf.SetTypeName('Xform')
-        elif parentPath is None:
-            xf = stage.CreateClassPrim(Sdf.Path(path_str))
-            xf.SetTypeName('Xform')
+        xf = path_str
+        writer.define_class(path_str)
+
+        if not asclass and parentPath is None:
             # define prim for root
-            root = UsdGeom.Xform.Define(stage, "/" + "/".join(path))
-            root.GetPrim().GetInherits().AddInherit(path_str)
-        else:
-            xf = stage.CreateClassPrim(Sdf.Path(path_str))
-            xf.SetTypeName('Xform')
+            writer.define("/" + "/".join(path), "Xform", inherits=[path_str])
 
         created_nodes[el] = xf
 
-        xf.CreateAttribute('customdata:originalStepInstance', Sdf.ValueTypeNames.String).Set(str(el))
-
-        if not el.is_a('IfcPropertySet'):
-            xf.CreateAttribute('ifc5:class:uri', Sdf.ValueTypeNames.String).Set(f'https://identifier.buildingsmart.org/uri/buildingsmart/ifc/4.3/class/{el.is_a().replace("Type", "")}')
-            xf.CreateAttribute('ifc5:class:code', Sdf.ValueTypeNames.String).Set(el.is_a().replace("Type", ""))
-
-        if el.is_a('IfcWall'):
-            xf.CreateAttribute('nlsfb:class:uri', Sdf.ValueTypeNames.String).Set(f'https://identifier.buildingsmart.org/uri/nlsfb/nlsfb2005/2.2/class/21.21')
-            xf.CreateAttribute('nlsfb:class:code', Sdf.ValueTypeNames.String).Set('21.21')
-
-        if el.is_a('IfcProduct') and el.ObjectPlacement:
-            write_placement(el.ObjectPlacement.RelativePlacement, xf)
-
-        if el.is_a('IfcDistributionPort'):
-            if fd := el.FlowDirection:
-                xf.CreateAttribute('ifc5:system:flowDirection', Sdf.ValueTypeNames.String).Set(fd)
-
-        if el in object_to_geom:
-            write_geom(el, xf)
-
-        if getattr(el, 'FillsVoids', ()):
-            write_geom(el.FillsVoids[0].RelatingOpeningElement, xf, override='Void')
-            write_placement(el.FillsVoids[0].RelatingOpeningElement.ObjectPlacement.RelativePlacement, xf)
-
-        for ty in types[el]:
-            xf.GetPrim().GetInherits().AddInherit(ty)
-
-        if getattr(el, 'Representation', None):
-            for r in [r for r in el.Representation.Representations if r.RepresentationIdentifier == 'Body']:
-                if os.path.basename(fn) == 'georeferenced-bridge-deck.ifc':
-                    shp = ifcopenshell.geom.create_shape(ifcopenshell.geom.settings(USE_WORLD_COORDS=True), el)
-                    xs,ys,zs = np.array(shp.geometry.verts).reshape((-1, 3)).T
-                    for i, x in enumerate((xs.min(), xs.max())):
-                        prim = stage.CreateClassPrim(f"/refpoint{i}")
-                        prim.SetTypeName("Points")
-                        pointclass = UsdGeom.Points(prim)
-                        pointclass.GetPointsAttr().Set(Vt.Vec3fArray([(0., 0., 0.)]))
-                        pointdef = UsdGeom.Points.Define(stage, xf.GetPath().pathString + f"/ReferencePoint{i}")
-                        pointdef.GetPrim().GetInherits().AddInherit(pointclass.GetPath())
+        writer.set_attribute(xf, 'customdata:originalStepInstance', 'String', str(el))
 
-                        mapc = f.by_type('IfcMapConversion')[0]
+        # in overlay mode the prims of unchanged elements are not written
+        for handle in dispatch(el) if dirty is None or el.GlobalId in dirty else ():
+            if on_handler:
+                t = time.perf_counter()
+                handle(el, xf)
+                on_handler(handle, time.perf_counter() - t)
+            else:
+                handle(el, xf)
 
-                        crs2d = mapc.TargetCRS.Name
-                        crsh = mapc.TargetCRS.VerticalDatum
+        if on_element:
+            on_element(len(created_nodes), el)
 
-                        M4 = np.eye(4)
-                        xyz = (x, 0., zs.min())
-                        M4[0:2,3] = xyz[0:2]
-
-                        UsdGeom.Xform(prim).AddTransformOp().Set(Gf.Matrix4d((M4.T)))
-
-                        the = np.arctan2(mapc.XAxisAbscissa, mapc.XAxisOrdinate)
-                        scm = np.zeros((3, 3))
-                        np.fill_diagonal(scm, mapc.Scale or 1)
-                        rot = np.array([
-                            [np.cos(the), -np.sin(the), 0],
-                            [np.sin(the), -np.cos(the), 0],
-                            [0,0,1]
-                        ])
-                        e,n,h = (rot @ scm @ xyz + (mapc.Eastings, mapc.Northings, mapc.OrthogonalHeight))
-
-                        from pyproj import Transformer
-                        to_latlon = Transformer.from_crs("EPSG:32610", "EPSG:4326")
-                        lat, lon = to_latlon.transform(e,n,h)[0:2]
-
-                        prim.CreateAttribute(f'{crs2d.lower().replace(":", "")}:eastings', Sdf.ValueTypeNames.Double).Set(e)
-                        prim.CreateAttribute(f'{crs2d.lower().replace(":", "")}:northings', Sdf.ValueTypeNames.Double).Set(n)
-                        prim.CreateAttribute(f'{crsh.lower().replace(":", "")}:height', Sdf.ValueTypeNames.Double).Set(h)
-                        prim.CreateAttribute(f'epsg4326:latitude', Sdf.ValueTypeNames.Double).Set(lat)
-                        prim.CreateAttribute(f'epsg4326:longitude', Sdf.ValueTypeNames.Double).Set(lon)
-
-                if r.Items[0].is_a('IfcExtrudedAreaSolid') and os.path.basename(fn) == 'bonsai-wall.ifc':
-                    B = ifcopenshell.ifcopenshell_wrapper.map_shape(ifcopenshell.geom.settings(), r.Items[0].wrapped_data)
-                    V = np.array(B.direction.components) * B.depth
-                    # @nb does not work for trimmed curves like this
-                    Ps = np.array([e.start.components for e in B.basis[0].children])
-
-                    line_points = np.array([
-                        Ps.min(axis=0),
-                        Ps.min(axis=0) + V
-                    ])
-                    
-                    prim = stage.CreateClassPrim(xf.GetPath().pathString + "_Directrix")
-                    prim.SetTypeName("BasisCurves")
-                    lineclass = UsdGeom.BasisCurves(prim)
-
-                    lineclass.GetPointsAttr().Set(Vt.Vec3fArray(line_points.tolist()))
-                    lineclass.GetCurveVertexCountsAttr().Set(Vt.IntArray([2]))
-                    lineclass.GetTypeAttr().Set(UsdGeom.Tokens.linear)
-                    lineclass.GetWidthsAttr().Set(Vt.FloatArray([0.01] * len(line_points)))
-                    linedef = UsdGeom.BasisCurves.Define(stage, xf.GetPath().pathString + "/Directrix")
-                    linedef.GetPrim().GetInherits().AddInherit(lineclass.GetPath())
-
-                    prim = stage.CreateClassPrim(xf.GetPath().pathString + "_Basis")
-                    prim.SetTypeName("Mesh")
-                    basisclass = UsdGeom.Mesh(prim)
-
-                    if True:
-                        # triangulate basis
-                        pd = pv.PolyData(Ps, [len(Ps), *range(len(Ps))]).triangulate()
-                        ps = pd.points.tolist()
-                        fs = pd.faces.reshape((-1, 4))[:,1:].flatten().tolist()
-
-                        basisclass.GetPointsAttr().Set(Vt.Vec3fArray(ps))
-                        basisclass.GetFaceVertexIndicesAttr().Set(Vt.IntArray(fs))
-                        basisclass.GetFaceVertexCountsAttr().Set(Vt.IntArray([3 for _ in range(len(fs))]))
-                    else:
-                        basisclass.GetPointsAttr().Set(Vt.Vec3fArray(Ps.tolist()))
-                        basisclass.GetFaceVertexIndicesAttr().Set(Vt.IntArray(np.arange(len(Ps)).tolist()))
-                        basisclass.GetFaceVertexCountsAttr().Set(Vt.IntArray([len(Ps)]))
-                    basisdef = UsdGeom.Mesh.Define(stage, xf.GetPath().pathString + "/Basis")
-                    basisdef.GetPrim().GetInherits().AddInherit(basisclass.GetPath())
-
-        if el.is_a('IfcAlignmentSegment'):
-            args = el.DesignParameters.get_info(recursive=True, include_identifier=False)
-            args.pop('type')
-            for k, v in args.items():
-                if v is not None:
-                    if isinstance(v, dict):
-                        v.pop('type')
-                        v = next(iter(v.values()))
-                    xf.GetPrim().CreateAttribute(f'ifc5:{el.DesignParameters.is_a()[3:]}:{k}', getSdfType(v)).Set(
-                        (v + (0.,)) if isinstance(v, tuple) and set(map(type, v)) == {float} else v
-                    )
+    segments = el.is_a('IfcLinearElement') and not el.is_a('IfcAlignment')
 
     for attr_name, other_end in inverses:
         for rel in getattr(el, attr_name, ()):
@@ -417,32 +494,51 @@ def process(el, path=(), parentPath=None, asclass=False):
                 children = [children]
             emitted = []
             for child in children:
-                xf2 = process(child, path, parentPath=path_str or parentPath)
+                xf2 = yield child, path, path_str or parentPath, False
                 emitted.append(xf2)
                 if xf2 is not None and path_str and FLATTEN_TREE:
                     if child.is_a('IfcOpeningElement'):
                         child = child.HasFillings[0].RelatedBuildingElement
-                    print(path_str, '->', xf2.GetPath().pathString + f"/{get_name(child)}")
-                    stage.DefinePrim(path_str + f"/{get_name(child)}").GetInherits().AddInherit(xf2.GetPath())
-            if attr_name == 'IsNestedBy' and el.is_a('IfcLinearElement') and not el.is_a('IfcAlignment'):
-                xf.GetPrim().ApplyAPI('AlignmentAPI')
-                rel = xf.GetPrim().GetRelationship('ifc5:alignment:segments')
-                for ch in emitted:
-                    rel.AddTarget(ch.GetPath())
+                    writer.define(path_str + f"/{get_name(child)}", inherits=[xf2])
+            if attr_name == 'IsNestedBy' and segments:
+                writer.add_targets(xf, 'ifc5:alignment:segments', emitted, api='AlignmentAPI')
+
+    if xf:
+        writer.flush(xf)
 
     return xf or xf2
 
+# traverse from project
+def process(el, path=(), parentPath=None, asclass=False):
+    """
+    Depth-first traversal on an explicit stack of visit() generators, so that
+    the depth of the decomposition is not limited by the recursion limit.
+    """
+    stack = [visit(el, path, parentPath, asclass)]
+    value = None
+    while stack:
+        try:
+            child = stack[-1].send(value)
+        except StopIteration as e:
+            stack.pop()
+            value = e.value
+        else:
+            stack.append(visit(*child))
+            value = None
+    return value
+
 for typeobj in [t for t in f.by_type('IfcTypeObject') if t.Types and len(t.Types[0].RelatedObjects) > 1]:
     if os.path.basename(fn) == 'domestic-hot-water.ifc' and typeobj.is_a('IfcWallType'):
         continue
 
     xf = process(typeobj, ('TypeLibrary',), asclass=True)
     for occ in typeobj.Types[0].RelatedObjects:
-        types[occ].append(xf.GetPath())
+        types[occ].append(xf)
     occ = typeobj.Types[0].RelatedObjects[0]
     if occ.FillsVoids:
         write_geom(occ.FillsVoids[0].RelatingOpeningElement, xf, override='Void', istype=True)
     write_geom(occ, xf, istype=True)
+    writer.flush(xf)
 
 DIRECT_PROPS = True
 
@@ -454,38 +550,41 @@ for typeobj in f.by_type('IfcPropertySet'):
         xf = process(typeobj, ('PropertyCollections',), asclass=True)
         if typeobj.DefinesOccurrence:
             for occ in typeobj.DefinesOccurrence[0].RelatedObjects:
-                types[occ].append(xf.GetPath())
+                types[occ].append(xf)
         for p in typeobj.HasProperties:
-            xf.GetPrim().CreateAttribute(f'ifc5:properties:{p.Name}', getSdfType(p.NominalValue[0])).Set(
+            writer.set_attribute(xf, f'ifc5:properties:{p.Name}', getSdfType(p.NominalValue[0]),
                 p.NominalValue[0]
             )
 
 xf = process(f.by_type('IfcProject')[0])
 
+if PROGRESS:
+    print(f'{len(created_nodes)} elements in {time.perf_counter() - t0:.1f}s')
+    for name, elapsed in handler_times.most_common():
+        print(f'  {name}: {elapsed:.2f}s')
+
 for rel in f.by_type('IfcRelSpaceBoundary'):
     # @todo I'd really want the window space bs listed under those of the wall..
     path_str = f"/{fmt_guid(rel.GlobalId)}"
-    xf = stage.CreateClassPrim(Sdf.Path(path_str))
-    xf.SetTypeName('Xform')
-    xf.ApplyAPI('SpaceBoundaryAPI')
-    xf.GetRelationship('ifc5:spaceboundary:relatingSpace')\
-        .AddTarget(created_nodes[rel.RelatingSpace].GetPath())
-    xf.GetRelationship('ifc5:spaceboundary:relatedElement')\
-        .AddTarget(created_nodes[rel.RelatedBuildingElement].GetPath())
+    xf = path_str
+    writer.define_class(path_str)
+    writer.add_targets(xf, 'ifc5:spaceboundary:relatingSpace', [created_nodes[rel.RelatingSpace]], api='SpaceBoundaryAPI')
+    writer.add_targets(xf, 'ifc5:spaceboundary:relatedElement', [created_nodes[rel.RelatedBuildingElement]], api='SpaceBoundaryAPI')
     geom = ifcopenshell.geom.create_shape(ifcopenshell.geom.settings(), rel.ConnectionGeometry.SurfaceOnRelatingElement)
     vs = np.array(geom.verts).reshape((-1, 3))
     idxs = np.array(geom.faces).reshape((-1, 3))
     eds = np.array(geom.edges).reshape((-1, 2))
     write_geom_2(xf, "Body", vs, idxs, eds)
-    stage.DefinePrim(created_nodes[rel.RelatingSpace].GetPath().pathString + f"/Boundary_{get_name(rel.RelatedBuildingElement)}").GetInherits().AddInherit(path_str)
+    writer.define(created_nodes[rel.RelatingSpace] + f"/Boundary_{get_name(rel.RelatedBuildingElement)}", inherits=[path_str])
+    writer.flush(xf)
 
 
 for system in f.by_type('IfcSystem'):
     path_str = f"/{fmt_guid(system.GlobalId)}"
-    xf = stage.CreateClassPrim(Sdf.Path(path_str))
-    xf.SetTypeName('Xform')
-    xf.CreateAttribute('ifc5:class:uri', Sdf.ValueTypeNames.String).Set(f'https://identifier.buildingsmart.org/uri/buildingsmart/ifc/5/class/{system.is_a().replace("Type", "")}')
-    xf.CreateAttribute('ifc5:class:code', Sdf.ValueTypeNames.String).Set(system.is_a().replace("Type", ""))
+    xf = path_str
+    writer.define_class(path_str)
+    writer.set_attribute(xf, 'ifc5:class:uri', 'String', f'https://identifier.buildingsmart.org/uri/buildingsmart/ifc/5/class/{system.is_a().replace("Type", "")}')
+    writer.set_attribute(xf, 'ifc5:class:code', 'String', system.is_a().replace("Type", ""))
 
     targets = []
     refs = system.ServicesBuildings + getattr(system, 'ServicesFacilities', ())
@@ -495,24 +594,22 @@ for system in f.by_type('IfcSystem'):
     if not targets:
         targets.append(f.by_type('IfcBuilding')[0])
 
-    rel = xf.GetPrim().CreateRelationship(f'ifc5:system:servicesFacility')
-    for elem in targets:
-        rel.AddTarget(created_nodes[elem].GetPath().pathString)
+    writer.add_targets(xf, f'ifc5:system:servicesFacility', [created_nodes[elem] for elem in targets])
 
     for ref in system.IsGroupedBy[0].RelatedObjects:
-        created_nodes[ref].GetPrim().CreateRelationship(f'ifc5:system:partOfSystem').AddTarget(path_str)
+        writer.add_targets(created_nodes[ref], f'ifc5:system:partOfSystem', [path_str])
 
     # if system.is_a('IfcDistributionSystem'):
     #     if pt := system.PredefinedType:
-    #         xf.CreateAttribute('ifc5:system:systemType', Sdf.ValueTypeNames.String).Set(pt)
+    #         writer.set_attribute(xf, 'ifc5:system:systemType', 'String', pt)
 
-    stage.DefinePrim(f"/{get_name(system)}").GetInherits().AddInherit(path_str)
+    writer.define(f"/{get_name(system)}", inherits=[path_str])
 
 
 for rel in f.by_type('IfcRelConnectsPorts'):
     cons = (rel.RelatedPort, rel.RelatingPort)
     for a, b in zip(cons, cons[::-1]):
-        created_nodes[a].GetPrim().CreateRelationship(f'ifc5:system:connectsTo').AddTarget(created_nodes[b].GetPath().pathString)
+        writer.add_targets(created_nodes[a], f'ifc5:system:connectsTo', [created_nodes[b]])
 
 
 for typeobj in f.by_type('IfcPropertySet'):
@@ -526,7 +623,7 @@ for typeobj in f.by_type('IfcPropertySet'):
                             return p.NominalValue[0]
                         except:
                             return p.EnumerationValues[0][0]
-                    created_nodes[el].GetPrim().CreateAttribute(f'ifc5:properties:{p.Name}', getSdfType(val())).Set(
+                    writer.set_attribute(created_nodes[el], f'ifc5:properties:{p.Name}', getSdfType(val()),
                         val()
                     )
 
@@ -544,31 +641,22 @@ mats = {
 for k, v in created_nodes.items():
     for m, mv in mats.items():
         if k.is_a(m):
-            UsdShade.MaterialBindingAPI.Apply(v.GetPrim())
-            material = UsdShade.Material.Define(stage, f'/{m[3:]}Material')
-            shader = UsdShade.Shader.Define(stage, f'/{m[3:]}Material/Shader')
-            shader.CreateIdAttr("UsdPreviewSurface")
-            shader.CreateInput("diffuseColor", Sdf.ValueTypeNames.Color3f).Set(Gf.Vec3f(*mv[0:3]))
-            shader.CreateInput("opacity", Sdf.ValueTypeNames.Float).Set(mv[3])
-            material.CreateSurfaceOutput().ConnectToSource(shader.ConnectableAPI(), "surface")
-            UsdShade.MaterialBindingAPI(v.GetPrim()).Bind(material)
+            writer.bind_material(v, m[3:], mv[0:3], mv[3])
 
 ##########################################################################
 ##########################################################################
 ##########################################################################
 
-stage.GetRootLayer().Save()
+writer.save()
 
 if os.path.basename(fn).startswith("bonsai-wall"):
-    newLayer = Sdf.Layer.CreateNew(ofn[:-5] + "-firerating.usda")
-    stage.GetRootLayer().subLayerPaths.append(newLayer.identifier)
-    stage.SetEditTarget(newLayer)
+    writer.sublayer(ofn[:-5] + "-firerating" + ofn[-5:])
     ratings = {
         'IfcWall': 'R60',
         'IfcWindow': 'R30'
     }
     for el, prim in created_nodes.items():
         if R := ratings.get(el.is_a()):
-            overPrim = stage.OverridePrim(prim.GetPath())
-            overPrim.CreateAttribute(f'ifc5:properties:firerating', getSdfType(R)).Set(R)
-    newLayer.Save()
+            writer.set_attribute(prim, f'ifc5:properties:firerating', getSdfType(R), R)
+    writer.save()
+
@@ -0,0 +1,170 @@
+import collections
+import contextlib
+import json
+
+import ifcx_json
+
+KEYS = ('children', 'inherits', 'attributes')
+REFERENCES = ('children', 'inherits')
+
+
+class IfcxDocument:
+    """
+    The nodes of an IFCX file in order, indexed by path, by the path their
+    children and inherits refer to and by attribute key. Nodes are added and
+    removed through the document, and changed in place within modify(), so
+    that the indexes stay up to date.
+    """
+
+    def __init__(self, obj=None):
+        obj = obj or {}
+        self.obj = {k: v for k, v in obj.items() if k != 'data'}
+        # nodes by id(), in order
+        self._nodes = {}
+        # the path index and the reverse indexes, from key to {entry: node}
+        self._index = {k: collections.defaultdict(dict) for k in ('path', *KEYS)}
+        self._composed = {}
+        self.extend(obj.get('data', ()))
+
+    @classmethod
+    def load(cls, fn):
+        with open(fn) as f:
+            return cls(json.load(f))
+
+    @property
+    def header(self):
+        return self.obj.get('header')
+
+    @property
+    def schemas(self):
+        return self.obj.setdefault('schemas', {})
+
+    @schemas.setter
+    def schemas(self, schemas):
+        self.obj['schemas'] = schemas
+
+    def __iter__(self):
+        # a copy, so that nodes can be added and removed while iterating
+        return iter(list(self._nodes.values()))
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __contains__(self, path):
+        return path in self._index['path']
+
+    def _entries(self, node):
+        # (index, key, entry) of `node` in the indexes, null values are not indexed
+        i = id(node)
+        yield 'path', node['path'], i
+        for k in REFERENCES:
+            for name, target in (node.get(k) or {}).items():
+                if target is not None:
+                    yield k, target, (i, name)
+        for key, v in (node.get('attributes') or {}).items():
+            if v is not None:
+                yield 'attributes', key, i
+
+    def _add(self, entry, node):
+        index, key, e = entry
+        self._index[index][key][e] = node
+
+    def _discard(self, entry):
+        index, key, e = entry
+        entries = self._index[index][key]
+        del entries[e]
+        if not entries:
+            del self._index[index][key]
+
+    def append(self, node):
+        self._nodes[id(node)] = node
+        for entry in self._entries(node):
+            self._add(entry, node)
+        self._composed.pop(node['path'], None)
+        return node
+
+    def extend(self, nodes):
+        for node in nodes:
+            self.append(node)
+
+    def remove(self, node):
+        del self._nodes[id(node)]
+        for entry in self._entries(node):
+            self._discard(entry)
+        self._composed.pop(node['path'], None)
+
+    def remove_path(self, path):
+        for node in self.records(path):
+            self.remove(node)
+
+    @contextlib.contextmanager
+    def modify(self, node):
+        """
+        Context in which `node` can be changed in place, except for its path.
+        Its index entries are updated on exit, those that did not change keep
+        their position.
+        """
+        path, before = node['path'], list(self._entries(node))
+        yield node
+        assert node['path'] == path, 'nodes are moved to another path by remove() and append()'
+        after = list(self._entries(node))
+        kept = set(before) & set(after)
+        for entry in before:
+            if entry not in kept:
+                self._discard(entry)
+        for entry in after:
+            if entry not in kept:
+                self._add(entry, node)
+        self._composed.pop(path, None)
+
+    def paths(self):
+        # in order of first occurrence
+        return list(self._index['path'])
+
+    def records(self, path):
+        return list(self._index['path'].get(path, {}).values())
+
+    def compose(self, path):
+        """
+        The records of `path` merged into one node, later records win like
+        Collapse() in workflows.ts, or None. Null values are kept. The node
+        is shared and should not be changed.
+        """
+        if path not in self._composed:
+            if path not in self:
+                return None
+            node = {'path': path, 'children': {}, 'inherits': {}, 'attributes': {}}
+            for r in self._index['path'][path].values():
+                for k in KEYS:
+                    node[k].update(r.get(k) or {})
+            self._composed[path] = node
+        return self._composed[path]
+
+    def referrers(self, path):
+        # (node, key, name) of the children and inherits of records that are `path`
+        return [(node, k, name) for k in REFERENCES for (i, name), node in self._index[k].get(path, {}).items()]
+
+    def _referring(self, k, path):
+        found = {}
+        for (i, name), node in self._index[k].get(path, {}).items():
+            if self.compose(node['path'])[k].get(name) == path:
+                found[node['path'], name] = None
+        return list(found)
+
+    def parents(self, path):
+        # (path, name) of the composed nodes that have `path` as a child
+        return self._referring('children', path)
+
+    def inheritors(self, path):
+        # (path, name) of the composed nodes that inherit from `path`
+        return self._referring('inherits', path)
+
+    def records_with(self, key):
+        # records with a non-null attribute `key`, in the order they were indexed
+        return list(self._index['attributes'].get(key, {}).values())
+
+    def to_json(self):
+        return {**self.obj, 'data': list(self._nodes.values())}
+
+    def dump(self, f, **kwargs):
+        ifcx_json.dump(self.to_json(), f, **kwargs)
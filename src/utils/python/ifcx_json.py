@@ -0,0 +1,126 @@
+import math
+import re
+
+from json.encoder import encode_basestring_ascii
+
+import numpy as np
+
+# lines of json.dumps() output that used to be joined with the previous line
+# by re.sub('\n\s+([\-\+\d\.e]+|\])(,?)(?=\n)', '\\1\\2', s)
+NUMBER = re.compile(r'[\-\+\d\.e]+')
+NUMBERS = re.compile(r'[\-\+\d\.e,]+')
+
+
+def scalar(o):
+    if isinstance(o, str):
+        return encode_basestring_ascii(o)
+    elif o is None:
+        return 'null'
+    elif o is True:
+        return 'true'
+    elif o is False:
+        return 'false'
+    elif isinstance(o, int):
+        return int.__repr__(o)
+    elif isinstance(o, float):
+        if math.isfinite(o):
+            return float.__repr__(o)
+        return 'NaN' if o != o else 'Infinity' if o > 0 else '-Infinity'
+    elif isinstance(o, np.generic):
+        return scalar(o.item())
+    raise TypeError(f'Object of type {o.__class__.__name__} is not JSON serializable')
+
+
+def key(k):
+    return encode_basestring_ascii(k if isinstance(k, str) else scalar(k))
+
+
+def iterencode(o, indent=2, compact=False, level=0):
+    """
+    Yields the chunks of json.dumps(o, indent=indent), one value at a time. With
+    `compact`, numbers in arrays and the closing brackets of nested arrays are
+    not put on a line of their own, as by the re.sub() usda-to-json.py applies
+    to the full text. Lines are indented by `level` additional levels. Numpy
+    arrays are encoded as (nested) lists, lists of numbers are joined at once.
+    """
+    indents = []
+
+    def newline(depth):
+        while len(indents) <= depth:
+            indents.append('\n' + ' ' * (indent * len(indents)))
+        return indents[depth]
+
+    def numbers(items):
+        # all items as numbers, or None
+        if items and set(map(type, items)) <= {int, float}:
+            s = ','.join(map(repr, items))
+            if NUMBERS.fullmatch(s):
+                return s
+
+    def encode(o, depth):
+        if isinstance(o, dict):
+            if not o:
+                yield '{}'
+                return
+            sep = '{' + newline(depth + 1)
+            for k, v in o.items():
+                if isinstance(v, (dict, list, tuple, np.ndarray)):
+                    yield sep + key(k) + ': '
+                    yield from encode(v, depth + 1)
+                else:
+                    yield sep + key(k) + ': ' + scalar(v)
+                sep = ',' + newline(depth + 1)
+            yield newline(depth) + '}'
+        elif isinstance(o, (list, tuple, np.ndarray)):
+            if isinstance(o, np.ndarray):
+                if o.ndim == 0:
+                    yield scalar(o.item())
+                    return
+                o = o.tolist()
+            if not o:
+                yield '[]'
+                return
+            close = newline(depth) + ']'
+            if compact and depth:
+                close = ']'
+            if s := numbers(o):
+                if compact:
+                    yield '[' + s + close
+                else:
+                    yield '[' + newline(depth + 1) + s.replace(',', ',' + newline(depth + 1)) + close
+                return
+            sep = '['
+            for v in o:
+                if isinstance(v, (dict, list, tuple, np.ndarray)):
+                    yield sep + newline(depth + 1)
+                    yield from encode(v, depth + 1)
+                else:
+                    s = scalar(v)
+                    if compact and NUMBER.fullmatch(s):
+                        yield sep + s
+                    else:
+                        yield sep + newline(depth + 1) + s
+                sep = ','
+            yield close
+        else:
+            yield scalar(o)
+
+    return encode(o, level)
+
+
+def dump(o, f, indent=2, compact=False, level=0, buffer_size=1 << 16):
+    """
+    Writes `o` to file `f` like json.dump(o, f, indent=indent), see iterencode().
+    """
+    chunks, size = [], 0
+    for chunk in iterencode(o, indent, compact, level):
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= buffer_size:
+            f.write(''.join(chunks))
+            chunks, size = [], 0
+    f.write(''.join(chunks))
+
+
+def dumps(o, indent=2, compact=False, level=0):
+    return ''.join(iterencode(o, indent, compact, level))
@@ -0,0 +1,274 @@
+import hashlib
+import itertools
+import re
+import uuid
+
+import ifcopenshell
+import ifcopenshell.guid
+
+import ifcx_json
+from ifcx_document import IfcxDocument
+from ifcx_writer import IfcxWriter
+from transform_prealpha_to_alpha import header
+
+
+def element_hashes(f, guids=None):
+    """
+    Returns a digest per GlobalId of the rooted entities in `f`, or of those
+    of `guids` that are in `f`. References to other rooted entities are
+    hashed by GlobalId, other instances by content, so that the digests do
+    not depend on step instance ids.
+    """
+    digests = {}
+
+    def digest(inst):
+        if inst.id() not in digests:
+            h = hashlib.sha1(inst.is_a().encode())
+            for v in inst:
+                h.update(repr(value(v)).encode())
+            digests[inst.id()] = h.hexdigest()
+        return digests[inst.id()]
+
+    def value(v):
+        if isinstance(v, ifcopenshell.entity_instance):
+            if not v.id():
+                return (v.is_a(), value(v.wrappedValue))
+            if v.is_a('IfcRoot'):
+                return ('guid', v.GlobalId)
+            return ('#', digest(v))
+        elif isinstance(v, (tuple, list)):
+            return tuple(map(value, v))
+        return v
+
+    if guids is None:
+        return {el.GlobalId: digest(el) for el in f.by_type('IfcRoot')}
+    return {g: digest(el) for g in guids if (el := by_guid(f, g))}
+
+
+def by_guid(f, g):
+    try:
+        return f.by_guid(g)
+    except RuntimeError:
+        return None
+
+
+def contents(f):
+    """
+    The type and attribute values of the instances in `f` by id, references
+    to other instances by id, so that the same instance in another file of
+    which the ids are kept compares equal.
+    """
+    def value(v):
+        if isinstance(v, ifcopenshell.entity_instance):
+            return v.id() or (v.is_a(), value(v.wrappedValue))
+        elif isinstance(v, tuple):
+            return tuple(map(value, v))
+        return v
+
+    return {inst.id(): (inst.is_a(), tuple(map(value, inst))) for inst in f}
+
+
+def candidates(f0, f1):
+    """
+    Returns the GlobalIds of the rooted entities that may have changed from
+    `f0` to `f1`: those reached from the instances of which the contents()
+    differ, for the same id, by following references up to the rooted
+    entities containing them. When files keep their ids, as when saved
+    again by the same application, this is a small part of the model.
+    """
+    c0, c1 = contents(f0), contents(f1)
+    differ = [i for i in c0.keys() | c1.keys() if c0.get(i) != c1.get(i)]
+    if len(differ) > len(c1) // 2:
+        # renumbered
+        return {el.GlobalId for f in (f0, f1) for el in f.by_type('IfcRoot')}
+
+    guids = set()
+    for f, other, c in ((f0, f1, c0), (f1, f0, c1)):
+        seen = set()
+        stack = [f.by_id(i) for i in differ if i in c]
+        while stack:
+            inst = stack.pop()
+            if inst.id() in seen:
+                continue
+            seen.add(inst.id())
+            if inst.is_a('IfcRoot'):
+                guids.add(inst.GlobalId)
+                # rooted entities refer to it by GlobalId, which only changes when its id holds another
+                try:
+                    if getattr(other.by_id(inst.id()), 'GlobalId', None) == inst.GlobalId:
+                        continue
+                except RuntimeError:
+                    pass
+            stack.extend(f.get_inverse(inst))
+    return guids
+
+
+def rooted(v):
+    # GlobalIds of the rooted entities in attribute value `v`
+    for x in (v if isinstance(v, (tuple, list)) else (v,)):
+        if isinstance(x, ifcopenshell.entity_instance) and x.id() and x.is_a('IfcRoot'):
+            yield x.GlobalId
+
+
+def sides(rel):
+    # GlobalIds of the relating and of the related entities of relationship `rel`
+    relating, related = set(), set()
+    for name, v in rel.get_info(include_identifier=False, recursive=False).items():
+        (relating if name.startswith('Relating') else related).update(rooted(v))
+    return relating, related
+
+
+# relationships of which the node of the relating entity is written with the
+# related ones, as its children, or for a type, with the geometry of its first
+# occurrence
+TO_RELATING = (
+    'IfcRelAggregates', 'IfcRelNests', 'IfcRelContainedInSpatialStructure',
+    'IfcRelVoidsElement', 'IfcRelFillsElement', 'IfcRelPositions',
+    'IfcRelDeclares', 'IfcRelDefinesByType', 'IfcRelSpaceBoundary',
+)
+
+# relationships of which the nodes of the related entities are written with the
+# relating one, as the attributes of a property set or the void of an opening
+TO_RELATED = ('IfcRelDefinesByProperties', 'IfcRelFillsElement')
+
+
+def is_a(el, types):
+    return any(el.is_a(t) for t in types)
+
+
+def dirty_elements(f0, f1):
+    """
+    Returns the GlobalIds of the rooted entities that were added, removed or
+    changed from `f0` to `f1`, and of those of which the converter writes
+    the node from them through a relationship: the parent of a changed child,
+    the type of its first occurrence, the objects of a property set. For a
+    changed relationship, its relating entities and the related ones that
+    were added or removed.
+    """
+    guids = candidates(f0, f1)
+    h0, h1 = element_hashes(f0, guids), element_hashes(f1, guids)
+    changed = {g for g in guids if h0.get(g) != h1.get(g)}
+    dirty = set(changed)
+    for g in changed:
+        for f, other in ((f0, f1), (f1, f0)):
+            if not (el := by_guid(f, g)):
+                continue
+            if el.is_a('IfcRelationship'):
+                relating, related = sides(el)
+                o = by_guid(other, g)
+                other_relating, other_related = sides(o) if o else (set(), set())
+                dirty |= relating
+                dirty |= related ^ other_related
+                if relating != other_relating:
+                    dirty |= related
+                continue
+            for rel in f.get_inverse(el):
+                if not rel.is_a('IfcRelationship'):
+                    continue
+                relating, related = sides(rel)
+                if g in related and is_a(rel, TO_RELATING):
+                    if not (rel.is_a('IfcRelDefinesByType') and rel.RelatedObjects[0] != el):
+                        dirty |= relating
+                if g in relating and is_a(rel, TO_RELATED):
+                    dirty |= related
+
+    # openings are not written, the fillings are children of the element voided
+    for g in list(dirty):
+        for f in (f0, f1):
+            if (el := by_guid(f, g)) and el.is_a('IfcOpeningElement'):
+                dirty.update(rel.RelatingBuildingElement.GlobalId for rel in el.VoidsElements)
+    return dirty
+
+
+def collapse(nodes):
+    # later nodes win, like Collapse() in workflows.ts
+    doc = IfcxDocument({'data': nodes})
+    return {p: doc.compose(p) for p in doc.paths()}
+
+
+def diff_nodes(node1, node2):
+    """
+    The changes from `node1` to `node2` as a node, with null for removed
+    children, inherits and attributes, like Diff() in workflows.ts. Returns
+    None if there are none.
+    """
+    result = {'path': node1['path']}
+    for k in ('children', 'inherits', 'attributes'):
+        d = {name: node2[k].get(name) for name in node1[k].keys() | node2[k].keys() if node1[k].get(name) != node2[k].get(name)}
+        if d:
+            result[k] = dict(sorted(d.items()))
+    if len(result) > 1:
+        return result
+
+
+def references(node):
+    yield from node['children'].values()
+    yield from node['inherits'].values()
+
+    def refs(v):
+        if isinstance(v, dict):
+            if isinstance(v.get('ref'), str):
+                yield v['ref']
+            for x in v.values():
+                yield from refs(x)
+        elif isinstance(v, list):
+            for x in v:
+                yield from refs(x)
+
+    yield from refs(node['attributes'])
+
+
+class OverlayWriter(IfcxWriter):
+    """
+    IfcxWriter that only writes the nodes of `dirty` elements, as the changes
+    relative to the nodes in `previous` (a loaded .ifcx file) converted from
+    a model with GlobalIds `elements`. Prims not named after an element, such
+    as roots and materials, are always diffed, and removed when no longer
+    referenced.
+    """
+
+    def __init__(self, fn, previous, dirty, elements):
+        self.previous = collapse(previous['data'])
+        self.dirty = {ifcopenshell.guid.expand(g) for g in dirty}
+        self.elements = {ifcopenshell.guid.expand(g) for g in elements}
+        super().__init__(fn)
+
+    def open(self, fn):
+        self.fn = fn
+        self.nodes = []
+
+    def write(self, node):
+        self.nodes.append(node)
+
+    def elem(self, path):
+        name = path.strip('/').split('/')[0]
+        if (m := re.match(r'N([0-9a-f]{32})', name)) and m.group(1) not in self.dirty:
+            # discarded
+            return {}
+        return super().elem(path)
+
+    def owned_paths(self, g):
+        # the node of an element and those of its geometry classes
+        path = str(uuid.UUID(g))
+        children = self.previous.get(path, {}).get('children', {})
+        return [path] + [p for n, p in children.items() if p == str(uuid.uuid5(uuid.UUID(path), n))]
+
+    def save(self):
+        self.flush()
+        empty = lambda path: {'path': path, 'children': {}, 'inherits': {}, 'attributes': {}}
+
+        current = collapse(self.nodes)
+        removed = [p for g in sorted(self.dirty) for p in self.owned_paths(g) if p not in current]
+
+        data = [diff_nodes(self.previous.get(p, empty(p)), node) for p, node in current.items()]
+        data += [diff_nodes(self.previous[p], empty(p)) for p in removed if p in self.previous]
+        data = list(filter(None, data))
+
+        # other nodes of the previous conversion are removed once unreferenced
+        owned = {p for g in self.elements for p in self.owned_paths(g)}
+        composed = collapse(itertools.chain(self.previous.values(), data))
+        referenced = {r for node in composed.values() for r in references(node) if r}
+        data += [diff_nodes(node, empty(p)) for p, node in self.previous.items() if p not in owned and p not in current and p not in referenced]
+
+        with open(self.fn, 'w') as f:
+            ifcx_json.dump({"header": header, "schemas": {}, "data": data}, f)
@@ -0,0 +1,48 @@
+import importlib
+import os
+import sys
+import time
+
+from ifcx_document import IfcxDocument
+
+# the post-processing chain, by default, modules with a process(doc) function
+passes = [
+    'populate_schema',
+    'externalise_schema',
+    'compact',
+    'split_window_bodies',
+    'calc_properties',
+    'rewrite_materials',
+]
+
+
+def run(doc, names, log=sys.stderr):
+    """
+    Applies the passes `names` to `doc` in order, in this process, and reports
+    the time each took on `log`. Returns the timings by name.
+    """
+    modules = [importlib.import_module(name.removesuffix('.py')) for name in names]
+    timings = {}
+    for name, module in zip(names, modules):
+        t0 = time.perf_counter()
+        module.process(doc)
+        timings[name] = time.perf_counter() - t0
+        print(f'{name}: {timings[name]:.3f}s', file=log)
+    return timings
+
+
+if __name__ == '__main__':
+    # passes from the command line, IFCX_PASSES or the default chain
+    ifn, ofn, *names = sys.argv[1:]
+    names = names or (os.environ.get('IFCX_PASSES') or '').split() or passes
+
+    t0 = time.perf_counter()
+    doc = IfcxDocument.load(ifn)
+    print(f'load: {time.perf_counter() - t0:.3f}s', file=sys.stderr)
+
+    run(doc, names)
+
+    t0 = time.perf_counter()
+    with open(ofn, 'w') as f:
+        doc.dump(f)
+    print(f'dump: {time.perf_counter() - t0:.3f}s', file=sys.stderr)
@@ -0,0 +1,155 @@
+import json
+import re
+
+import ifcx_json
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+decoder = json.JSONDecoder()
+
+
+class Reader:
+    """
+    Decodes the JSON text in file `f` one value at a time, from a buffer of
+    about `buffer_size` characters that only grows to hold the value being
+    decoded.
+    """
+
+    def __init__(self, f, buffer_size=1 << 16):
+        self.f = f
+        self.buffer_size = buffer_size
+        self.s, self.i, self.eof = '', 0, False
+
+    def fill(self, size):
+        # appends up to `size` characters to what is left of the buffer
+        self.s, self.i = self.s[self.i:], 0
+        chunk = self.f.read(size)
+        self.eof = not chunk
+        self.s += chunk
+        return bool(chunk)
+
+    def peek(self):
+        # the next character that is not whitespace, or '' at the end
+        while True:
+            self.i = WHITESPACE.match(self.s, self.i).end()
+            if self.i < len(self.s):
+                return self.s[self.i]
+            if not self.fill(self.buffer_size):
+                return ''
+
+    def expect(self, chars):
+        c = self.peek()
+        if not c or c not in chars:
+            raise ValueError(f'Expected one of {chars!r}, got {c!r}')
+        self.i += 1
+        return c
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                v, end = decoder.raw_decode(self.s, self.i)
+                # a number at the end of what is buffered may continue after it
+                if self.eof or end < len(self.s) and self.s[end] not in '+-.0123456789Ee':
+                    self.i = end
+                    return v
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # at least doubles the buffer, so that a value is decoded a few times at most
+            self.fill(max(self.buffer_size, len(self.s) - self.i))
+
+    def elements(self):
+        # the elements of the array that follows, one at a time
+        self.expect('[')
+        if self.peek() == ']':
+            self.i += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(',]') == ']':
+                return
+
+
+def read(f, buffer_size=1 << 16):
+    """
+    Yields the members of the IFCX file `f` as (key, value), in file order,
+    except for "data" of which the nodes are yielded one at a time as
+    ("data", node). Memory use is bounded by the largest value or node.
+    """
+    r = Reader(f, buffer_size)
+    r.expect('{')
+    if r.peek() == '}':
+        return
+    while True:
+        k = r.value()
+        r.expect(':')
+        if k == 'data' and r.peek() == '[':
+            for node in r.elements():
+                yield k, node
+        else:
+            yield k, r.value()
+        if r.expect(',}') == '}':
+            return
+
+
+def read_array(f, buffer_size=1 << 16):
+    # the elements of a JSON array in file `f`, such as a prealpha file, one at a time
+    return Reader(f, buffer_size).elements()
+
+
+class Writer:
+    """
+    Writes an IFCX file to `f` a member at a time and the data nodes one at a
+    time, as ifcx_json.dump() would write the whole file. Members written
+    after the first node follow the data.
+    """
+
+    def __init__(self, f, indent=2, compact=False):
+        self.f = f
+        self.indent = indent
+        self.compact = compact
+        self.sep = '{'
+        # None before the data, then the number of nodes, then 'closed'
+        self.num_nodes = None
+
+    def newline(self, level):
+        return '\n' + ' ' * (self.indent * level)
+
+    def begin(self, key):
+        self.f.write(self.sep + self.newline(1) + ifcx_json.key(key) + ': ')
+        self.sep = ','
+
+    def write(self, key, value):
+        self.end_data()
+        self.begin(key)
+        ifcx_json.dump(value, self.f, self.indent, self.compact, level=1)
+
+    def begin_data(self):
+        if self.num_nodes is None:
+            self.begin('data')
+            self.f.write('[')
+            self.num_nodes = 0
+
+    def node(self, node):
+        self.begin_data()
+        self.f.write((',' if self.num_nodes else '') + self.newline(2))
+        ifcx_json.dump(node, self.f, self.indent, self.compact, level=2)
+        self.num_nodes += 1
+
+    def end_data(self):
+        if isinstance(self.num_nodes, int):
+            self.f.write(']' if self.compact or not self.num_nodes else self.newline(1) + ']')
+            self.num_nodes = 'closed'
+
+    def close(self):
+        # with an empty data array if there were no nodes
+        self.begin_data()
+        self.end_data()
+        self.f.write(self.newline(0) + '}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,305 @@
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+
+import numpy as np
+
+import ifcx_stream
+from externalise_schema import prefix
+
+
+class SchemaValidationError(Exception):
+    pass
+
+
+def short(v, n=60):
+    # `v` as text for messages, without the bulk of large values
+    s = str(v)
+    return s if len(s) <= n else s[:n] + '...'
+
+
+def is_number(v):
+    return isinstance(v, (int, float)) and not isinstance(v, bool)
+
+
+# dataType: (test, expected type in messages), as in schema-validation.ts
+scalars = {
+    "Boolean": (lambda v: isinstance(v, bool), "boolean"),
+    "String": (lambda v: isinstance(v, str), "string"),
+    "DateTime": (lambda v: isinstance(v, str), "date"),
+    "Reference": (lambda v: isinstance(v, str), "string"),
+    "Integer": (is_number, "int"),
+    "Real": (is_number, "real"),
+}
+
+
+def numeric_shape(desc):
+    """
+    For nested arrays of numbers without further restrictions, the (min, max)
+    length per level, checked on the value as an ndarray at once, else None.
+    """
+    bounds = []
+    while desc.get("dataType") == "Array" and not desc.get("inherits"):
+        r = desc["arrayRestrictions"]
+        bounds.append((r.get("min"), r.get("max")))
+        desc = r["value"]
+    if bounds and desc.get("dataType") in ("Real", "Integer") and not desc.get("inherits"):
+        return bounds
+
+
+class Validator:
+    """
+    Checks attribute values against `schemas`, the IfcxSchema by id. Each
+    schema is compiled once into a tree of checker functions that take the
+    value, where in the value it is, for messages, and the list of errors
+    to append (where, message) to.
+    """
+
+    def __init__(self, schemas):
+        self.schemas = schemas
+        self.checkers = {}
+
+    def checker(self, schema_id):
+        # of the schema `schema_id`, or None if it is unknown
+        if schema_id not in self.checkers:
+            schema = self.schemas.get(schema_id)
+            # a placeholder while compiling, for schemas that inherit from themselves
+            self.checkers[schema_id] = lambda v, where, errors: None
+            self.checkers[schema_id] = schema and self.compile(schema["value"])
+        return self.checkers[schema_id]
+
+    def compile(self, desc):
+        inherited = [self.compile_inherited(i) for i in desc.get("inherits") or ()]
+        check = self.compile_type(desc)
+        if not inherited:
+            return check
+
+        def check_all(v, where, errors):
+            for c in inherited:
+                c(v, where, errors)
+            check(v, where, errors)
+        return check_all
+
+    def compile_inherited(self, schema_id):
+        def check(v, where, errors):
+            if c := self.checker(schema_id):
+                c(v, where, errors)
+            else:
+                errors.append((where, f'Unknown inherited schema id "{schema_id}"'))
+        return check
+
+    def compile_type(self, desc):
+        data_type = desc.get("dataType")
+
+        if data_type in scalars:
+            test, name = scalars[data_type]
+            def check(v, where, errors):
+                if not test(v):
+                    errors.append((where, f'Expected "{short(v)}" to be of type {name}'))
+            return check
+
+        elif data_type == "Enum":
+            options = desc["enumRestrictions"]["options"]
+            allowed = frozenset(options)
+            def check(v, where, errors):
+                if not isinstance(v, str):
+                    errors.append((where, f'Expected "{short(v)}" to be of type string'))
+                elif v not in allowed:
+                    errors.append((where, f'Expected "{short(v)}" to be one of [{",".join(options)}]'))
+            return check
+
+        elif data_type == "Object":
+            values = [
+                (k, self.compile(d), d.get("optional"))
+                for k, d in ((desc.get("objectRestrictions") or {}).get("values") or {}).items()
+            ]
+            def check(v, where, errors):
+                if not isinstance(v, dict):
+                    errors.append((where, f'Expected "{short(v)}" to be of type object'))
+                    return
+                for k, c, optional in values:
+                    if k in v:
+                        c(v[k], f"{where}.{k}", errors)
+                    elif not optional:
+                        errors.append((where, f'Expected "{short(v)}" to have key {k}'))
+            return check
+
+        elif data_type == "Array":
+            r = desc["arrayRestrictions"]
+            item = self.compile(r["value"])
+            lo, hi = r.get("min"), r.get("max")
+            shape = numeric_shape(desc)
+            def check(v, where, errors):
+                if not isinstance(v, list):
+                    errors.append((where, f'Expected "{short(v)}" to be of type array'))
+                    return
+                if shape:
+                    # as objects, as numpy would take booleans among numbers for numbers
+                    try:
+                        a = np.array(v, dtype=object)
+                    except ValueError:
+                        # ragged
+                        a = None
+                    if a is not None and a.ndim == len(shape) and all(
+                        (l is None or n >= l) and (h is None or n <= h) for n, (l, h) in zip(a.shape, shape)
+                    ) and set(map(type, a.flat)) <= {int, float}:
+                        return
+                if lo is not None and len(v) < lo:
+                    errors.append((where, f"Expected at least {lo} items, got {len(v)}"))
+                if hi is not None and len(v) > hi:
+                    errors.append((where, f"Expected at most {hi} items, got {len(v)}"))
+                for i, x in enumerate(v):
+                    item(x, f"{where}[{i}]", errors)
+            return check
+
+        else:
+            def check(v, where, errors):
+                errors.append((where, f"Unexpected datatype {data_type}"))
+            return check
+
+    def node(self, node):
+        # the violations of the attributes of `node`, as messages
+        messages = []
+        for k, v in (node.get("attributes") or {}).items():
+            # null removes an attribute
+            if v is None or k.startswith("__internal"):
+                continue
+            check = self.checker(k)
+            if check is None:
+                messages.append(f'Missing schema "{k}" referenced by ["{node["path"]}"].attributes')
+                continue
+            errors = []
+            check(v, "", errors)
+            for where, message in errors:
+                messages.append(f'Error validating ["{node["path"]}"].attributes["{k}"]{where}: {message}')
+        return messages
+
+
+def load_schemas(obj, web='../../../web/', seen=None):
+    """
+    The schemas of IFCX file `obj` and of the files it imports, those under
+    `prefix` looked up in `web` as externalise_schema.py writes them, with
+    the messages for the imports that cannot be found.
+    """
+    seen = set() if seen is None else seen
+    schemas, messages = {}, []
+    for imp in obj.get("imports") or ():
+        uri = imp["uri"]
+        fn = web + uri[len(prefix) + 1:] if uri.startswith(prefix + "/") else uri
+        if fn in seen:
+            continue
+        seen.add(fn)
+        try:
+            with open(fn) as f:
+                imported = json.load(f)
+        except OSError:
+            messages.append(f'Unresolved import "{uri}"')
+            continue
+        s, m = load_schemas(imported, web, seen)
+        schemas.update(s)
+        messages.extend(m)
+    schemas.update(obj.get("schemas") or {})
+    return schemas, messages
+
+
+def validate_nodes(nodes):
+    # in worker processes, with the schemas passed to init_worker()
+    return [m for node in nodes for m in worker_validator.node(node)]
+
+
+def init_worker(schemas):
+    global worker_validator
+    worker_validator = Validator(schemas)
+
+
+def validate(nodes, schemas, num_workers=None, chunk_size=10000):
+    """
+    Yields the violations of the attributes of `nodes` against `schemas`,
+    in order. With `num_workers` > 1, chunks of nodes are validated in a
+    pool of worker processes, each compiling the schemas once.
+    """
+    if num_workers is None:
+        num_workers = int(os.environ.get('IFCX_VALIDATE_WORKERS') or 1)
+    if num_workers > 1 and not (isinstance(nodes, list) and len(nodes) <= chunk_size):
+        it = iter(nodes)
+        chunks = iter(lambda: list(itertools.islice(it, chunk_size)), [])
+        with multiprocessing.Pool(num_workers, init_worker, (schemas,)) as pool:
+            # a few chunks per worker at a time, so that an iterator is not read ahead
+            while window := list(itertools.islice(chunks, num_workers * 4)):
+                for messages in pool.imap(validate_nodes, window):
+                    yield from messages
+    else:
+        validator = Validator(schemas)
+        for node in nodes:
+            yield from validator.node(node)
+
+
+def process(doc):
+    # as a pass of ifcx_pipeline.py, raises with all the violations in `doc`
+    schemas, messages = load_schemas(doc.obj)
+    messages += validate(doc, schemas)
+    if messages:
+        raise SchemaValidationError('\n'.join(messages))
+
+
+def read_nodes(fn):
+    with open(fn) as f:
+        for k, node in ifcx_stream.read(f):
+            if k == 'data':
+                yield node
+
+
+def stream(fn):
+    """
+    The members of IFCX file `fn` other than data, and an iterator of its
+    nodes read one at a time. The file is read once when its imports and
+    schemas come before the data, else twice, as members after the data
+    are only known at the end.
+    """
+    f = open(fn)
+    members = ifcx_stream.read(f)
+    obj = {}
+    for k, v in members:
+        if k == "data":
+            first = v
+            break
+        obj[k] = v
+    else:
+        f.close()
+        return obj, iter(())
+
+    def nodes(f):
+        with f:
+            for k, v in itertools.chain([("data", first)], members):
+                if k == "data":
+                    yield v
+                else:
+                    obj[k] = v
+
+    if "schemas" in obj and "imports" in obj:
+        return obj, nodes(f)
+
+    f.close()
+    with open(fn) as f:
+        obj = {k: v for k, v in ifcx_stream.read(f) if k != "data"}
+    return obj, read_nodes(fn)
+
+
+if __name__ == '__main__':
+    # in memory for a node at a time rather than for the whole file
+    if os.environ.get('IFCX_STREAM'):
+        obj, nodes = stream(sys.argv[1])
+    else:
+        obj = json.load(open(sys.argv[1]))
+        nodes = obj.get("data") or []
+
+    ostream = open(sys.argv[2], 'w') if len(sys.argv) > 2 else sys.stdout
+
+    schemas, messages = load_schemas(obj)
+    num_errors = 0
+    for m in itertools.chain(messages, validate(nodes, schemas)):
+        print(m, file=ostream)
+        num_errors += 1
+    sys.exit(1 if num_errors else 0)
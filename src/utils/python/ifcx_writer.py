@@ -0,0 +1,199 @@
+import numpy as np
+
+import ifcx_stream
+from transform_prealpha_to_alpha import header, transform_element
+
+
+# powers of ten that are exact in float64
+POWERS = 10. ** np.arange(23)
+
+
+def shortest(a):
+    """
+    The float64 values of the shortest decimal text of float32 array `a`, as
+    str() writes them: per element, the fewest digits of which the nearest
+    decimal, or for asymmetric intervals the next nearest, reads back as the
+    same float32. Ties and exponents past exact powers of ten use str().
+    """
+    x32 = a.ravel()
+    x = x32.astype(np.float64)
+    out = x.copy()
+    todo = np.flatnonzero(np.isfinite(x) & (x != 0))
+    with np.errstate(divide='ignore'):
+        e = np.floor(np.log10(np.abs(x[todo]))).astype(np.int64)
+    fallback = []
+    for k in range(1, 11):
+        if not len(todo):
+            break
+        p = k - 1 - e
+        ok = np.abs(p) <= 22
+        fallback.append(todo[~ok])
+        todo, e, p = todo[ok], e[ok], p[ok]
+        # the k digits, scaled by an exact power, so that the decimal they
+        # stand for is read as the correctly rounded quotient or product
+        scale = POWERS[np.abs(p)]
+        s = np.where(p >= 0, x[todo] * scale, x[todo] / scale)
+        m = np.rint(s)
+        tie = np.abs(np.abs(s - m) - .5) < 1e-5
+        found = np.zeros(len(todo), dtype=bool)
+        for c in (m, m + np.sign(s - m)):
+            v = np.where(p >= 0, c / scale, c * scale)
+            hit = ~found & ~tie & (v.astype(np.float32) == x32[todo])
+            out[todo[hit]] = v[hit]
+            found |= hit
+        fallback.append(todo[tie & ~found])
+        keep = ~found & ~tie
+        todo, e = todo[keep], e[keep]
+    fallback.append(todo)
+    for i in np.concatenate(fallback).tolist():
+        out[i] = float(str(x32[i]))
+    return out.reshape(a.shape)
+
+
+def usd_values(v, dtype=np.float64):
+    """
+    Numeric values as they come out of a round-trip through .usda text: the
+    shortest representation at the precision of `dtype`, integral values
+    without decimals. Converted as whole arrays, only mixed arrays of
+    integral and other values are assembled per element.
+    """
+    a = np.asarray(v, dtype=dtype)
+    if dtype == np.float32:
+        f = shortest(a)
+    else:
+        f = a.astype(np.float64)
+    integral = np.isfinite(f) & (np.floor(f) == f)
+    if a.ndim == 0:
+        return int(f) if integral else f.item()
+    small = integral & (np.abs(f) < 2. ** 63)
+    if small.all():
+        return f.astype(np.int64).tolist()
+    if not integral.any():
+        return f.tolist()
+    o = f.astype(object)
+    o[small] = f[small].astype(np.int64).astype(object)
+    o[integral & ~small] = [int(x) for x in f[integral & ~small].tolist()]
+    return o.tolist()
+
+
+class IfcxWriter:
+    """
+    Writes the prims emitted by ifc4-to-usda.py directly as IFCX alpha nodes,
+    without authoring a USD stage. Prims are held in the intermediate form
+    produced by usda-to-json.py (attributes grouped by namespace) and are
+    transformed by transform_prealpha_to_alpha.py when flushed, so the nodes
+    compose to the same result as the three-step pipeline.
+
+    Prims are written out when flushed, data authored on a prim afterwards
+    is written as an additional node for the same path.
+    """
+
+    def __init__(self, fn):
+        self.defs = {}
+        self.pending = {}
+        self.original_instance_names = {}
+        self.file = None
+        self.open(fn)
+
+    def open(self, fn):
+        self.file = open(fn, 'w')
+        self.writer = ifcx_stream.Writer(self.file)
+        self.writer.write("header", header)
+        self.writer.write("schemas", {})
+        self.writer.begin_data()
+
+    def write(self, node):
+        self.writer.node(node)
+
+    def elem(self, path):
+        name, *sub = path.strip('/').split('/')
+        if name not in self.pending:
+            self.pending[name] = {'def': self.defs.setdefault(name, 'class'), 'name': name}
+        e = self.pending[name]
+        for n in sub:
+            e = e.setdefault('children', {}).setdefault(n, {'name': n})
+        return e
+
+    def define_class(self, path, type_name='Xform'):
+        self.defs.setdefault(path.strip('/').split('/')[0], 'class')
+        self.elem(path)
+
+    def define(self, path, type_name=None, inherits=()):
+        if path.count('/') == 1:
+            self.defs.setdefault(path[1:], 'def')
+        for ih in inherits:
+            self.add_inherit(path, ih)
+
+    def add_inherit(self, path, target):
+        self.elem(path).setdefault('inherits', []).append(f'<{target}>')
+
+    def set_attributes(self, path, ns, attrs):
+        self.elem(path).setdefault('attributes', {}).setdefault(ns, {}).update(attrs)
+
+    def set_attribute(self, path, name, type_name, value):
+        if type_name == 'Float':
+            value = usd_values(value, np.float32)
+        elif type_name in ('Double', 'Point3d'):
+            value = usd_values(value)
+        if name == 'customdata:originalStepInstance':
+            self.original_instance_names[path.strip('/')] = value.split('=')[1].split('(')[0]
+        ns, k = name.rsplit(':', 1)
+        self.set_attributes(path, ns, {k: value})
+
+    def set_transform(self, path, matrix):
+        self.set_attributes(path, 'xformOp', {'transform': usd_values(matrix)})
+
+    def set_mesh(self, path, vs, idxs):
+        self.set_attributes(path, 'UsdGeom:Mesh', {
+            'points': usd_values(vs, np.float32),
+            'faceVertexIndices': np.asarray(idxs).ravel().tolist()
+        })
+
+    def set_curves(self, path, points, counts):
+        self.set_attributes(path, 'UsdGeom:BasisCurves', {
+            'points': usd_values(points, np.float32),
+            **({'curveVertexCounts': list(counts)} if list(counts) != [2] else {})
+        })
+
+    def set_points(self, path, points):
+        self.set_attributes(path, 'points:array', {'positions': usd_values(points, np.float32)})
+
+    def set_invisible(self, path):
+        self.set_attributes(path, 'UsdGeom:VisibilityAPI:visibility', {'visibility': 'invisible'})
+
+    def add_targets(self, path, name, targets, api=None):
+        ns, k = name.rsplit(':', 1)
+        attrs = self.elem(path).setdefault('attributes', {}).setdefault(ns, {})
+        refs = attrs.setdefault(k, [])
+        for t in targets:
+            # like relationship targets in USD, refs are unique
+            if {'ref': f'<{t}>'} not in refs:
+                refs.append({'ref': f'<{t}>'})
+
+    def bind_material(self, path, name, color, opacity):
+        material = f'{name}Material'
+        if material not in self.defs:
+            self.defs[material] = 'def'
+            self.elem(f'/{material}/Shader')['attributes'] = {
+                'info:id': 'UsdPreviewSurface',
+                'inputs:diffuseColor': usd_values(color, np.float32),
+                'inputs:opacity': usd_values(opacity, np.float32),
+            }
+        self.set_attributes(path, 'UsdShade:MaterialBindingAPI', {'material:binding': [{'ref': f'</{material}>'}]})
+
+    def flush(self, path=None):
+        names = [path.strip('/').split('/')[0]] if path else list(self.pending)
+        for name in names:
+            if e := self.pending.pop(name, None):
+                if 'children' in e:
+                    e['children'] = list(e['children'].values())
+                for node in transform_element(e, self.original_instance_names):
+                    self.write(node)
+
+    def sublayer(self, fn):
+        self.open(fn)
+
+    def save(self):
+        self.flush()
+        self.writer.close()
+        self.file.close()
@@ -0,0 +1,204 @@
+import collections
+import hashlib
+import itertools
+import json
+import os
+import sys
+
+import numpy as np
+
+from ifcx_document import IfcxDocument
+
+MESH = 'usd::usdgeom::mesh'
+XFORM = 'usd::xformop'
+
+
+def refs(v):
+    # paths of the {"ref": ...} values in attribute value `v`
+    if isinstance(v, dict):
+        if isinstance(v.get('ref'), str):
+            yield v['ref'].split('/')[0]
+        for x in v.values():
+            yield from refs(x)
+    elif isinstance(v, list) and not numeric(v):
+        for x in v:
+            yield from refs(x)
+
+
+def numeric(v):
+    # lists of numbers and of lists of numbers, judged by their first item
+    while isinstance(v, list) and v:
+        v = v[0]
+    return isinstance(v, (int, float))
+
+
+def canonical(points, indices):
+    """
+    Returns the points of a triangle mesh relative to its origin (minimum
+    corner), its triangles and the origin.
+    """
+    points = np.asarray(points, dtype=float).reshape((-1, 3))
+    origin = points.min(axis=0)
+    return points - origin, np.asarray(indices, dtype=np.int64).reshape((-1, 3)), origin
+
+
+def sorted_triangles(tris):
+    """
+    The (..., n, 3) triangles of one or more meshes, each starting at its
+    lowest index, keeping the winding, in sorted order per mesh.
+    """
+    first = np.argmin(tris, axis=-1)
+    tris = np.take_along_axis(tris, (first[..., None] + np.arange(3)) % 3, axis=-1)
+    flat = tris.reshape((-1, 3))
+    mesh = np.repeat(np.arange(flat.shape[0] // tris.shape[-2]), tris.shape[-2])
+    return flat[np.lexsort((flat[:, 2], flat[:, 1], flat[:, 0], mesh))].reshape(tris.shape)
+
+
+def cells(q):
+    # rows of quantized coordinates as sortable scalars
+    return np.ascontiguousarray(q, dtype=np.int64).view(np.dtype((np.void, 24))).ravel()
+
+
+def match(a, b, tolerance):
+    """
+    Lowest index of a point in `a` within `tolerance` of each point in `b`, or
+    len(a). Points are looked up in a grid of cells of twice the tolerance, in
+    their own cell and the neighbouring ones towards the nearest boundaries,
+    compared with every point of `a` in those cells.
+    """
+    qa, qb = a / (2 * tolerance), b / (2 * tolerance)
+    keys = cells(np.floor(qa))
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    towards = np.where(qb % 1 < 0.5, -1, 1)
+    result = np.full(len(b), len(a))
+    for mask in itertools.product((0, 1), repeat=3):
+        k = cells(np.floor(qb) + towards * mask)
+        lo, hi = np.searchsorted(keys, k, 'left'), np.searchsorted(keys, k, 'right')
+        # (point in b, point in a) for every point of a in the cell
+        counts = hi - lo
+        ib = np.repeat(np.arange(len(b)), counts)
+        j = order[np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - lo, counts)]
+        hit = np.abs(a[j] - b[ib]).max(axis=1) <= tolerance
+        np.minimum.at(result, ib[hit], j[hit])
+    return result
+
+
+def welded(points, tolerance):
+    # index of the lowest point within tolerance of each point, transitively
+    index = match(points, points, tolerance)
+    while not np.array_equal(index, index[index]):
+        index = index[index]
+    return index
+
+
+def same(m0, ms, tolerance):
+    """
+    Whether each of the meshes `ms` equals `m0` within `tolerance`, up to the
+    order of points and triangles, compared at once. The meshes have as many
+    points and triangles as `m0`.
+    """
+    p0, t0, _ = m0
+    # welded, with unmatched points mapped to -1
+    weld = np.append(welded(p0, tolerance), -1)
+    index = match(p0, np.concatenate([m[0] for m in ms]), tolerance).reshape((len(ms), -1))
+    tris = np.stack([m[1] for m in ms])
+    tris = weld[index[np.arange(len(ms))[:, None, None], tris]]
+    return (sorted_triangles(tris) == sorted_triangles(weld[t0])).all(axis=(1, 2)) & (index < len(p0)).all(axis=1)
+
+
+def is_mesh(node):
+    # triangle meshes without children or inherits of their own
+    mesh = node['attributes'].get(MESH)
+    return (
+        isinstance(mesh, dict) and mesh.keys() == {'points', 'faceVertexIndices'} and
+        len(mesh['faceVertexIndices']) % 3 == 0 and len(mesh['points']) and
+        not any(node['children'].values()) and not any(node['inherits'].values())
+    )
+
+
+def translation(d):
+    m = np.eye(4)
+    m[3, 0:3] = d
+    return m
+
+
+def process(doc, tolerance=None):
+    """
+    Merges the meshes of `doc` that are equal within `tolerance` after a
+    translation, by default IFCX_MESH_TOLERANCE or 1e-5.
+    """
+    if tolerance is None:
+        tolerance = float(os.environ.get('IFCX_MESH_TOLERANCE') or 1e-5)
+
+    # paths referred to from attributes keep their node
+    pinned = {r for p in doc.paths() for r in refs(doc.compose(p)['attributes'])}
+
+    # candidate meshes by hash of their sizes quantized at a coarser grid, so
+    # that noise does not move them to another bucket, and their other attributes
+    candidates = collections.defaultdict(list)
+    canonicals = {}
+    meshes = {n['path'] for n in doc.records_with(MESH)}
+    for p in filter(meshes.__contains__, doc.paths()):
+        node = doc.compose(p)
+        if not (doc.parents(p) or doc.inheritors(p) or p in pinned) or not is_mesh(node):
+            continue
+        mesh = node['attributes'][MESH]
+        canonicals[p] = points, tris, origin = canonical(mesh['points'], mesh['faceVertexIndices'])
+        other = {k: v for k, v in node['attributes'].items() if k != MESH}
+        h = hashlib.blake2b(digest_size=16)
+        h.update(np.array((len(points), len(tris)), dtype=np.int64).tobytes())
+        h.update(np.round(points.max(axis=0) / (tolerance * 1000)).astype(np.int64).tobytes())
+        h.update(json.dumps(other, sort_keys=True).encode())
+        candidates[h.digest()].append(p)
+
+    remapped = {}
+    replaced = {}
+
+    for paths in (ps for ps in candidates.values() if len(ps) > 1):
+        # the first of the remaining meshes in the bucket is shared by those equal to it
+        while len(paths) > 1:
+            tgt, *paths = paths
+            equal = same(canonicals[tgt], [canonicals[p] for p in paths], tolerance)
+            for src in itertools.compress(paths, equal):
+                d = canonicals[src][2] - canonicals[tgt][2]
+                if np.abs(d).max() <= tolerance and src not in pinned:
+                    remapped[src] = tgt
+                else:
+                    # keeps its path, inherits the shared mesh and moves it in place
+                    xform = doc.compose(src)['attributes'].get(XFORM, {}).get('transform')
+                    m = translation(d) @ (np.array(xform, dtype=float) if xform is not None else np.eye(4))
+                    replaced[src] = {
+                        'path': src,
+                        'inherits': {'mesh': tgt},
+                        'attributes': {XFORM: {'transform': m.tolist()}},
+                    }
+            paths = list(itertools.compress(paths, ~equal))
+
+    print(len(canonicals), len(remapped), len(replaced))
+
+    for src, tgt in remapped.items():
+        for node, k, name in doc.referrers(src):
+            with doc.modify(node):
+                node[k][name] = tgt
+        doc.remove_path(src)
+
+    for src, node in replaced.items():
+        # all records of the path are replaced by one, in place of the first
+        first, *rest = doc.records(src)
+        with doc.modify(first):
+            first.clear()
+            first.update(node)
+        for r in rest:
+            doc.remove(r)
+
+
+if __name__ == '__main__':
+    ifn, ofn = sys.argv[1:]
+
+    doc = IfcxDocument.load(ifn)
+    process(doc)
+
+    with open(ofn, 'w') as f:
+        doc.dump(f, compact=True)
+        f.write('\n')
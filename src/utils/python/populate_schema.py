@@ -1,12 +1,54 @@
-import json
+import itertools
+import os
 import sys
 
-obj = json.load(open(sys.argv[1]))
+import numpy as np
+
+import ifcx_stream
+from ifcx_document import IfcxDocument
+
 known_quants = {
     "volume": {"quantityKind": "Volume"},
-    "height": {"quantityKind": "Length"}
+    "height": {"quantityKind": "Length"},
+    "surfacearea": {"quantityKind": "Area"},
+    "footprintarea": {"quantityKind": "Area"},
+    "boundingboxmin": {"quantityKind": "Length"},
+    "boundingboxmax": {"quantityKind": "Length"},
+    "centroid": {"quantityKind": "Length"}
 }
 
+
+def numeric(v):
+    """
+    For `v` nested lists of numbers of the same length at every level, the
+    type of the numbers and the depth, from the dtype numpy gives them at
+    once, else None.
+    """
+    try:
+        a = np.asarray(v)
+    except ValueError:
+        # ragged
+        return None
+    if a.size and a.dtype.kind in 'iuf':
+        return (float if a.dtype.kind == 'f' else int), a.ndim
+
+
+def signature(v):
+    """
+    The structure and types of value `v` that make_schema() depends on, as
+    a hashable value. The items of arrays of numbers are typed at once, those
+    of other arrays one by one.
+    """
+    if isinstance(v, dict):
+        return dict, tuple((k, signature(x)) for k, x in v.items())
+    elif isinstance(v, list):
+        if n := numeric(v):
+            return list, n
+        types = frozenset(map(type, v))
+        return list, types, (signature(v[0]) if v else None)
+    return type(v)
+
+
 def make_schema(v, path=[]):
     if isinstance(v, dict):
         return {
@@ -16,21 +58,25 @@ def make_schema(v, path=[]):
             }
         }
     elif isinstance(v, list):
-        if set(map(type, v)) == {int, float}:
-            return {
-                "dataType": "Array",
-                "arrayRestrictions": {
-                    "value": {
-                        "dataType": "Real"
+        if n := numeric(v):
+            # ints among floats as Real, like a float
+            t, depth = n
+            schema = make_schema(t(), path)
+            for i in range(depth):
+                schema = {
+                    "dataType": "Array",
+                    "arrayRestrictions": {
+                        "value": schema
                     }
                 }
-            }
+            return schema
         else:
-            assert len(set(map(type, v))) == 1
+            types = set(map(type, v))
+            assert len(types) == 1
             return {
                 "dataType": "Array",
                 "arrayRestrictions": {
-                    "value": make_schema(v[0], [*path, k])
+                    "value": make_schema(v[0], path)
                 }
             }
     elif isinstance(v, float):
@@ -73,36 +119,103 @@ def unify_schemas(left, right):
     if not (left.keys() <= right.keys() or right.keys() <= left.keys()):
         return None
     di = {
-        k: unify_schemas(left.get(k), right.get(k)) for k in (left.keys() | right.keys())
+        k: unify_schemas(left.get(k), right.get(k)) for k in dict.fromkeys([*left, *right])
     }
     if None in di.values():
         return None
     return di
 
 
+class Inference:
+    """
+    The schemas of attributes, merged incrementally as nodes, possibly of
+    several files, are added. A schema is made and merged once per attribute
+    and signature() of its values.
+    """
+
+    def __init__(self):
+        self.schemas = {}
+        self.seen = set()
+
+    def update(self, nodes):
+        for elem in nodes:
+            if attr := elem.get("attributes"):
+                for k, v in attr.items():
+                    # null removes an attribute, it has no type
+                    if v is None or (s := (k, signature(v))) in self.seen:
+                        continue
+                    self.seen.add(s)
+                    self.merge(k, { "value": make_schema(v, [k]) })
+        return self
 
-schema = {}
-for elem in obj["data"]:
-    if attr := elem.get("attributes"):
-        for k, v in attr.items():
-            new_schema = { "value": make_schema(v, [k]) }
-            if old_schema := schema.get(k):
-                if new_schema != old_schema: 
-                    unified = unify_schemas(old_schema, new_schema)
-                    if unified:
-                        schema[k] = unified
-                    else:
-                        breakpoint()
-                        assert False
-            else:
-                schema[k] = new_schema
-
-obj["schemas"] = schema
-
-ostream = None
-try:
-    ostream = open(sys.argv[2], 'w')
-except: 
-    ostream = sys.stdout
-
-json.dump(obj, ostream, indent=2)
+    def merge(self, k, new_schema):
+        if old_schema := self.schemas.get(k):
+            if new_schema != old_schema: 
+                unified = unify_schemas(old_schema, new_schema)
+                if unified:
+                    self.schemas[k] = unified
+                else:
+                    breakpoint()
+                    assert False
+        else:
+            self.schemas[k] = new_schema
+
+
+def infer(nodes):
+    # the schemas of the attributes of `nodes`, inferred from their values
+    return Inference().update(nodes).schemas
+
+
+def read_nodes(fn):
+    with open(fn) as f:
+        for k, node in ifcx_stream.read(f):
+            if k == 'data':
+                yield node
+
+
+def process(doc, others=()):
+    # with the schemas of the attributes of the IFCX files `others` merged in
+    doc.schemas = infer(itertools.chain(doc, *map(read_nodes, others)))
+
+
+def stream(fn, ostream, others=()):
+    """
+    Writes IFCX file `fn` with the schemas inferred from its attributes, and
+    those of the files `others`, to `ostream`, reading the files a node at a
+    time.
+    """
+    schema = infer(itertools.chain(read_nodes(fn), *map(read_nodes, others)))
+    with open(fn) as f, ifcx_stream.Writer(ostream) as w:
+        written = False
+        for k, v in ifcx_stream.read(f):
+            if k in ('data', 'schemas') and not written:
+                w.write('schemas', schema)
+                written = True
+            if k == 'data':
+                w.node(v)
+            elif k != 'schemas':
+                w.write(k, v)
+        if not written:
+            w.write('schemas', schema)
+
+
+if __name__ == '__main__':
+    # in memory for a node at a time rather than for the whole file
+    streaming = bool(os.environ.get('IFCX_STREAM'))
+    # files after the output only contribute their attributes to the schemas
+    others = sys.argv[3:]
+
+    if not streaming:
+        doc = IfcxDocument.load(sys.argv[1])
+        process(doc, others)
+
+    ostream = None
+    try:
+        ostream = open(sys.argv[2], 'w')
+    except: 
+        ostream = sys.stdout
+
+    if streaming:
+        stream(sys.argv[1], ostream, others)
+    else:
+        doc.dump(ostream)
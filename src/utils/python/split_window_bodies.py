@@ -1,13 +1,13 @@
-import itertools
-import json
+import os
 import sys
 import uuid
 import numpy as np
-import networkx as nx
 
-obj = json.load(open(sys.argv[1]))
+from ifcx_document import IfcxDocument
 
-def make_material(name):
+MESH = 'usd::usdgeom::mesh'
+
+def make_material(doc, name):
     assert name.lower() in ("concrete", "glass", "wood")
     colors = {
         "concrete": [0.5,0.5,0.5],
@@ -28,80 +28,176 @@ def make_material(name):
         }
     }
     
-    if d not in obj["data"]:
-        obj["data"].append(d)
+    if d not in doc.records(d["path"]):
+        doc.append(d)
     return d
 
-parents = dict(itertools.chain.from_iterable(([(c, o['path']) for k, c in o['children'].items() if k != 'Void'] for o in obj['data'] if o.get('children'))))
+def mix(h):
+    # the 64 bit finalizer of MurmurHash3, in place
+    h ^= h >> np.uint64(33)
+    h *= np.uint64(0xFF51AFD7ED558CCD)
+    h ^= h >> np.uint64(33)
+    h *= np.uint64(0xC4CEB9FE1A85EC53)
+    h ^= h >> np.uint64(33)
+    return h
 
-to_remove = []
 
-for d in [d for d in list(obj['data']) if d.get('attributes', {}).get('usd::usdgeom::mesh')]:
-    mesh = d['attributes']['usd::usdgeom::mesh']
-    g = nx.Graph()
-    indices = np.array(mesh["faceVertexIndices"], dtype=int)
-    points = np.array(mesh["points"], dtype=float)
+def weld(points, tolerance=0.):
+    """
+    Group of each point, shared by points with the same coordinates, or with
+    the same coordinates rounded to `tolerance`, numbered from 0.
+    """
+    if tolerance:
+        points = np.round(points / tolerance)
+    # + 0. as -0. has other bits
+    bits = np.ascontiguousarray(points + 0., dtype=float).view(np.uint64)
+    h = mix(mix(mix(bits[:, 0].copy()) ^ bits[:, 1]) ^ bits[:, 2])
+    order = np.argsort(h)
+    rows = bits[order]
+    same = h[order][1:] == h[order][:-1]
+    if (same & (rows[1:] != rows[:-1]).any(axis=1)).any():
+        # hash collision, sort on the coordinates themselves
+        order = np.lexsort(bits.T[::-1])
+        rows = bits[order]
+        same = (rows[1:] == rows[:-1]).all(axis=1)
+    group = np.empty(len(points), dtype=np.int64)
+    group[order] = np.concatenate(([0], np.cumsum(~same)))
+    return group
 
-    g = nx.Graph()
-    for i in range(0, len(indices), 3):
-      for j in range(3):
-        k = tuple(points[indices[i + j]])
-        l = tuple(points[indices[i + ((j + 1) % 3)]])
-        g.add_edge(k, l)
-    
-    for i, comp in enumerate(nx.connected_components(g)):
-        comp2 = np.concatenate([np.where(np.sum(points == p, axis=1) == 3)[0] for p in comp])
-        comp2.sort()
-        assert comp2[-1] - comp2[0] == len(comp2) - 1
-        points2 = points[comp2]
-        indices2 = np.array([i for i in indices if i in range(comp2[0], comp2[-1]+1)]) - comp2[0]
-        if indices.size != indices2.size:
-            try:
-                # delete existing mesh on body
-                del d['attributes']['usd::usdgeom::mesh']
-            except:
-                pass
-
-            name = 'Frame' if points2.T[1].ptp() > 0.02 else 'Glazing'
-            child_guid = str(uuid.uuid5(uuid.UUID(d['path']), name))
-            
-            obj['data'].append({
-                "path": child_guid,
-                "attributes": {
-                    'usd::usdgeom::mesh': {
-                        'faceVertexIndices': indices2.tolist(),
-                        'points': points2.tolist()
+
+def connected_components(indices, num_points, welded=None):
+    """
+    Component label of each of `num_points` points, connected by the triangles
+    in `indices` and, optionally, by being in the same `welded` group. Labels
+    are propagated to the lowest index over all edges at once, with pointer
+    jumping in between, so this takes a few vectorized passes.
+    """
+    tris = indices.reshape((-1, 3))
+    if welded is not None:
+        # on the welded groups, which are mapped back to the points at the end
+        tris = welded[tris]
+        num_points = int(welded.max()) + 1 if len(welded) else 0
+    u, v = tris[:, 0:2].ravel(), tris[:, 1:3].ravel()
+    labels = np.arange(num_points)
+    while True:
+        lu, lv = labels[u], labels[v]
+        if np.array_equal(lu, lv):
+            break
+        # hook the root of the larger label onto the smaller one
+        low = np.minimum(lu, lv)
+        np.minimum.at(labels, lu, low)
+        np.minimum.at(labels, lv, low)
+        while not np.array_equal(labels, jumped := labels[labels]):
+            labels = jumped
+    return labels if welded is None else labels[welded]
+
+
+def split(indices, labels):
+    """
+    Yields the point indices and the triangles on them of each component with
+    triangles, in order of their first triangle. Components need not be
+    contiguous ranges of points.
+    """
+    tris = indices.reshape((-1, 3))
+    tri_labels = labels[tris[:, 0]]
+    components, first = np.unique(tri_labels, return_index=True)
+    components = components[np.argsort(first)]
+
+    # components numbered in order, points without triangles last, as small
+    # integers where possible, which numpy sorts stably in linear time
+    number = np.full(len(labels), len(components))
+    number[components] = np.arange(len(components))
+    dtype = np.uint16 if len(components) < 2 ** 16 else np.int64
+    point_numbers, tri_numbers = number[labels].astype(dtype), number[tri_labels].astype(dtype)
+
+    # points and triangles grouped by component, in their original order
+    point_order = np.argsort(point_numbers, kind='stable')
+    point_bounds = np.concatenate(([0], np.cumsum(np.bincount(point_numbers, minlength=len(components) + 1))))
+    tri_order = np.argsort(tri_numbers, kind='stable')
+    tri_bounds = np.concatenate(([0], np.cumsum(np.bincount(tri_numbers, minlength=len(components)))))
+
+    # index of each point within its component
+    local = np.empty(len(labels), dtype=np.int64)
+    local[point_order] = np.arange(len(labels)) - point_bounds[point_numbers[point_order]]
+
+    for i in range(len(components)):
+        yield point_order[point_bounds[i]:point_bounds[i + 1]], local[tris[tri_order[tri_bounds[i]:tri_bounds[i + 1]]]].ravel()
+
+
+# coincident points of a mesh are connected, within IFCX_WELD_TOLERANCE if given
+weld_tolerance = float(os.environ.get('IFCX_WELD_TOLERANCE') or 0.)
+
+
+def process(doc):
+    """
+    Splits the meshes of `doc` into their connected components, as the Frame
+    and Glazing children of the element, with a wood or glass material.
+    """
+    to_remove = []
+
+    for d in doc.records_with(MESH):
+        mesh = d['attributes'][MESH]
+        indices = np.array(mesh["faceVertexIndices"], dtype=int)
+        points = np.array(mesh["points"], dtype=float).reshape((-1, 3))
+
+        labels = connected_components(indices, len(points), weld(points, weld_tolerance))
+        # before the body is removed from its parent below
+        parents = [p for p, k in doc.parents(d['path']) if k != 'Void']
+
+        for comp2, indices2 in split(indices, labels):
+            points2 = points[comp2]
+            if indices.size != indices2.size:
+                with doc.modify(d):
+                    # delete existing mesh on body
+                    d['attributes'].pop(MESH, None)
+
+                name = 'Frame' if np.ptp(points2.T[1]) > 0.02 else 'Glazing'
+                my_parents = [x for x in doc.records(parents[-1]) if 'children' in x]
+                assert len(my_parents) == 1
+                my_parent = my_parents[0]
+                with doc.modify(my_parent):
+                    my_parent['children'].pop('Body', None)
+
+                    while name in my_parent['children']:
+                        name_parts = name.split('_')
+                        if len(name_parts) == 1:
+                            name, suffix = name, 1
+                        else:
+                            name, suffix = name_parts
+                            suffix = int(suffix) + 1
+                        name = f'{name}_{suffix:03d}'
+
+                    # after numbering, so that every component has a path of its own
+                    child_guid = str(uuid.uuid5(uuid.UUID(d['path']), name))
+                    my_parent['children'][name] = child_guid
+
+                doc.append({
+                    "path": child_guid,
+                    "attributes": {
+                        MESH: {
+                            'faceVertexIndices': indices2.tolist(),
+                            'points': points2.tolist()
+                        }
+                    },
+                    "inherits": {
+                        "material": make_material(doc, "wood" if np.ptp(points2.T[1]) > 0.02 else "glass")["path"]
                     }
-                },
-                "inherits": {
-                    "material": make_material("wood" if points2.T[1].ptp() > 0.02 else "glass")["path"]
-                }
-            })
-            my_parents = [x for x in obj['data'] if x['path'] == parents[d['path']] and 'children' in x]
-            assert len(my_parents) == 1
-            my_parent = my_parents[0]
-            try:
-                del my_parent['children']['Body']
-            except: pass
-            
-            while name in my_parent['children']:
-                name_parts = name.split('_')
-                if len(name_parts) == 1:
-                    name, suffix = name, 1
-                else:
-                    name, suffix = name_parts
-                    suffix = int(suffix)
-                name = f'{name}_{suffix:03d}'
-            my_parent['children'][name] = child_guid
-
-            to_remove.append(d['path'])
-
-obj['data'] = [x for x in obj['data'] if x['path'] not in to_remove]
-
-ostream = None
-try:
-    ostream = open(sys.argv[2], 'w')
-except: 
-    ostream = sys.stdout
-
-json.dump(obj, ostream, indent=2)
+                })
+
+                to_remove.append(d['path'])
+
+    for path in to_remove:
+        doc.remove_path(path)
+
+
+if __name__ == '__main__':
+    doc = IfcxDocument.load(sys.argv[1])
+    process(doc)
+
+    ostream = None
+    try:
+        ostream = open(sys.argv[2], 'w')
+    except: 
+        ostream = sys.stdout
+
+    doc.dump(ostream)
@@ -0,0 +1,300 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import tempfile
+import time
+
+import numpy as np
+
+import ifcopenshell
+import ifcopenshell.geom
+
+
+def num_workers():
+    return int(os.environ.get('IFCX_TESSELLATION_WORKERS') or multiprocessing.cpu_count())
+
+
+def tessellate(f, settings, num_threads=None, cache=None, store=None, products=None):
+    """
+    Tessellates the products in `f` on `num_threads` ifcopenshell worker threads
+    and returns a list of (product, context, geometry id, verts, faces, edges).
+
+    Workers finish in arbitrary order, so the results are sorted on product and
+    geometry id to make the output independent of the worker count.
+
+    Products found in `cache` are excluded from the iterator, newly
+    tessellated products are added to it.
+
+    With a `store`, arrays are spilled to disk as soon as they are produced and
+    returned as memory-mapped views, so memory use does not grow with the model.
+
+    With `products`, only those are tessellated rather than all products in `f`.
+    """
+    num_threads = num_threads or num_workers()
+    spill = store.put if store else lambda *arrays: arrays
+
+    if products is not None:
+        products = [el for el in products if el.Representation]
+
+    results = []
+    pending = {}
+
+    if cache:
+        for el in f.by_type('IfcProduct') if products is None else products:
+            if not el.Representation:
+                continue
+            if (geoms := cache.get(el)) is None:
+                pending[el.id()] = []
+            else:
+                results.extend((el.id(), ctx, gid, *spill(*arrays)) for ctx, gid, *arrays in geoms)
+        print(f'{len(results)} shapes from tessellation cache, {len(pending)} products to tessellate')
+
+    t0 = time.perf_counter()
+    num_shapes = 0
+
+    cached = {r[0] for r in results}
+    if products is None:
+        # @nb cached products are excluded rather than the others included,
+        # so that the default filtering of the iterator still applies
+        selection = {'exclude': [f[id] for id in cached] or None}
+    else:
+        selection = {'include': [el for el in products if el.id() not in cached]}
+
+    if (not cache or pending) and (products is None or selection['include']):
+        for geom in ifcopenshell.geom.iterate(settings, f, num_threads, **selection):
+            r = (
+                geom.id,
+                geom.context,
+                geom.geometry.id,
+                *spill(
+                    np.array(geom.geometry.verts).reshape((-1, 3)),
+                    np.array(geom.geometry.faces).reshape((-1, 3)),
+                    np.array(geom.geometry.edges).reshape((-1, 2)),
+                )
+            )
+            results.append(r)
+            if geom.id in pending:
+                pending[geom.id].append(r[1:])
+            num_shapes += 1
+
+    report(num_shapes, time.perf_counter() - t0, num_threads)
+
+    if store:
+        results = [(id, ctx, gid, *store.get(*handles)) for id, ctx, gid, *handles in results]
+        pending = {id: [(ctx, gid, *store.get(*handles)) for ctx, gid, *handles in geoms] for id, geoms in pending.items()}
+
+    if cache:
+        # products without output are stored as well, so they are skipped next time
+        for id, geoms in pending.items():
+            cache.put(f[id], geoms)
+        cache.evict()
+
+    results.sort(key=lambda r: (r[0], r[2]))
+    return [(f[id], *r) for id, *r in results]
+
+
+class Store:
+    """
+    Append-only temporary file of geometry arrays. `put` returns handles,
+    `get` returns the arrays as read-only views on a memory map of the file,
+    which the OS pages in and out as they are used.
+    """
+
+    def __init__(self, dir=None):
+        self.file = tempfile.TemporaryFile(dir=dir)
+        self.size = 0
+        self.map = None
+
+    @staticmethod
+    def from_environ():
+        if dir := os.environ.get('IFCX_GEOMETRY_STORE'):
+            os.makedirs(dir, exist_ok=True)
+            return Store(dir)
+
+    def put(self, *arrays):
+        handles = []
+        for a in arrays:
+            a = np.ascontiguousarray(a)
+            # keep offsets aligned for the views in get()
+            self.file.write(bytes(-self.size % 8))
+            self.size += -self.size % 8
+            handles.append((self.size, a.dtype.str, a.shape))
+            self.file.write(a.tobytes())
+            self.size += a.nbytes
+        return handles
+
+    def get(self, *handles):
+        if self.map is None or len(self.map) < self.size:
+            self.file.flush()
+            self.map = np.memmap(self.file, dtype=np.uint8, mode='r') if self.size else None
+        arrays = []
+        for offset, dtype, shape in handles:
+            dtype = np.dtype(dtype)
+            n = int(np.prod(shape)) * dtype.itemsize
+            if n:
+                arrays.append(self.map[offset:offset + n].view(dtype).reshape(shape))
+            else:
+                arrays.append(np.empty(shape, dtype))
+        return arrays
+
+
+def mesh_hash(vs, idxs, eds, local=False):
+    """
+    Returns a digest of the geometry arrays, and, when `local`, the minimum of
+    the bounding box of `vs`. The vertices are then hashed relative to that
+    minimum, so that translated copies of a mesh have the same digest.
+    """
+    offset = None
+    if local and len(vs):
+        offset = vs.min(axis=0)
+        # round off noise from the subtraction, adding zero normalizes -0.
+        vs = np.round(vs - offset, 9) + 0.
+
+    h = hashlib.sha1()
+    for a, dtype in ((vs, np.float64), (idxs, np.int64), (eds, np.int64)):
+        a = np.ascontiguousarray(a, dtype=dtype)
+        h.update(repr(a.shape).encode())
+        h.update(a.tobytes())
+    return h.hexdigest()[0:32], offset
+
+
+def report(num_shapes, elapsed, num_threads):
+    # @nb the ifcopenshell iterator does not expose which thread produced a
+    # shape, so per-worker throughput is the average over the pool
+    rate = num_shapes / elapsed if elapsed else 0.
+    print(f'tessellated {num_shapes} shapes in {elapsed:.2f}s on {num_threads} workers')
+    print(f'  {rate:.1f} shapes/s total, {rate / num_threads:.1f} shapes/s per worker')
+
+
+def settings_key(settings):
+    def get(name):
+        try:
+            return settings.get(name)
+        except RuntimeError:
+            return None
+    return repr((ifcopenshell.version, [(n, get(n)) for n in settings.setting_names()]))
+
+
+def traverse(f, roots):
+    seen = {}
+    for root in filter(None, roots):
+        for inst in f.traverse(root):
+            seen.setdefault(inst.id(), inst)
+    return list(seen.values())
+
+
+def content(instances, h):
+    """
+    Feeds the attribute values of `instances` into hash `h`, with references
+    replaced by their position in `instances`, so that the hash does not
+    depend on step instance ids.
+    """
+    index = {inst.id(): i for i, inst in enumerate(instances)}
+
+    def value(v):
+        if isinstance(v, ifcopenshell.entity_instance):
+            if v.id():
+                return ('#', index[v.id()])
+            return (v.is_a(), value(v.wrappedValue))
+        elif isinstance(v, (tuple, list)):
+            return tuple(map(value, v))
+        return v
+
+    for inst in instances:
+        h.update(repr((inst.is_a(), tuple(value(inst[i]) for i in range(len(inst))))).encode())
+
+
+class Cache:
+    """
+    On-disk store of tessellation results, keyed by the content of the
+    representation subgraph of a product (including its openings) and the
+    geometry settings. Entries are uncompressed .npz files, the least recently
+    used ones are evicted once the directory grows beyond `max_size` bytes.
+    """
+
+    def __init__(self, path, f, settings, max_size=1024 ** 3):
+        self.path = path
+        self.file = f
+        self.max_size = max_size
+        os.makedirs(path, exist_ok=True)
+
+        # geometry is converted to project units, so these are part of every key
+        self.salt = hashlib.sha1(settings_key(settings).encode())
+        for project in f.by_type('IfcProject'):
+            content(traverse(f, [project.UnitsInContext]), self.salt)
+
+    @staticmethod
+    def from_environ(f, settings):
+        if path := os.environ.get('IFCX_TESSELLATION_CACHE'):
+            max_size = int(os.environ.get('IFCX_TESSELLATION_CACHE_SIZE') or 1024) * 1024 ** 2
+            return Cache(path, f, settings, max_size)
+
+    def subgraph(self, el):
+        openings = [rel.RelatedOpeningElement for rel in getattr(el, 'HasOpenings', ())]
+        instances = traverse(self.file, [el.Representation] + [x for o in openings for x in (o.Representation, o.ObjectPlacement)])
+        h = self.salt.copy()
+        h.update(el.is_a().encode())
+        content(instances, h)
+        # the openings themselves are only referenced by id in geometry ids
+        return h.hexdigest(), [i.id() for i in instances + openings]
+
+    def filename(self, key):
+        return os.path.join(self.path, key[0:2], key + '.npz')
+
+    def get(self, el):
+        key, ids = self.subgraph(el)
+        fn = self.filename(key)
+        try:
+            with np.load(fn) as npz:
+                meta = json.loads(str(npz['meta']))
+                geoms = [(
+                    ctx,
+                    re.sub(r'#(\d+)', lambda m: str(ids[int(m.group(1))]), gid),
+                    npz[f'verts{i}'],
+                    npz[f'faces{i}'].astype(int),
+                    npz[f'edges{i}'].astype(int),
+                ) for i, (ctx, gid) in enumerate(meta)]
+        except (FileNotFoundError, KeyError, ValueError):
+            return None
+        os.utime(fn)
+        return geoms
+
+    def put(self, el, geoms):
+        key, ids = self.subgraph(el)
+        position = {id: i for i, id in enumerate(ids)}
+
+        def template(gid):
+            return re.sub(r'\d+', lambda m: f'#{position[int(m.group(0))]}' if int(m.group(0)) in position else m.group(0), gid)
+
+        arrays = {'meta': np.array(json.dumps([(ctx, template(gid)) for ctx, gid, *_ in geoms]))}
+        for i, (_, _, vs, idxs, eds) in enumerate(geoms):
+            arrays[f'verts{i}'] = vs
+            arrays[f'faces{i}'] = idxs.astype(np.int32)
+            arrays[f'edges{i}'] = eds.astype(np.int32)
+
+        fn = self.filename(key)
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        # write to a temporary file and rename, so that concurrent runs never see partial entries
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fn), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as g:
+            np.savez(g, **arrays)
+        os.replace(tmp, fn)
+
+    def evict(self):
+        entries = []
+        for root, _, files in os.walk(self.path):
+            for fn in files:
+                if fn.endswith('.npz'):
+                    st = os.stat(os.path.join(root, fn))
+                    entries.append((st.st_mtime, st.st_size, os.path.join(root, fn)))
+        size = sum(e[1] for e in entries)
+        for _, sz, fn in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(fn)
+            except FileNotFoundError:
+                pass
+            size -= sz
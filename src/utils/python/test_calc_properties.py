@@ -0,0 +1,74 @@
+import numpy as np
+
+import calc_properties
+import compact
+from calc_properties import MESH, PROP, XFORM
+from ifcx_document import IfcxDocument
+
+
+# a unit cube
+CUBE = {
+    'points': [[x, y, z] for x in (0., 1.) for y in (0., 1.) for z in (0., 1.)],
+    'faceVertexIndices': [
+        0, 1, 3, 0, 3, 2, 4, 6, 7, 4, 7, 5, 0, 4, 5, 0, 5, 1,
+        2, 3, 7, 2, 7, 6, 0, 2, 6, 0, 6, 4, 1, 5, 7, 1, 7, 3,
+    ],
+}
+
+
+def translation(x):
+    m = np.eye(4)
+    m[3, 0] = x
+    return m.tolist()
+
+
+def node(path, children=None, inherits=None, attributes=None):
+    return {'path': path, 'children': children or {}, 'inherits': inherits or {}, 'attributes': attributes or {}}
+
+
+def props(doc, path):
+    attrs = doc.compose(path)['attributes']
+    return {k[len(PROP):]: v for k, v in attrs.items() if k.startswith(PROP)}
+
+
+def test_mesh_shared_by_compact_counts_for_every_element():
+    doc = IfcxDocument({'data': [
+        node('storey', {'w1': 'w1', 'w2': 'w2'}),
+        node('w1', {'Body': 'w1_body'}, attributes={XFORM: {'transform': translation(0.)}}),
+        node('w2', {'Body': 'w2_body'}, attributes={XFORM: {'transform': translation(10.)}}),
+        node('w1_body', attributes={MESH: CUBE}),
+        node('w2_body', attributes={MESH: CUBE}),
+    ]})
+    compact.process(doc)
+    assert doc.compose('w2')['children']['Body'] == 'w1_body'
+
+    calc_properties.process(doc)
+    w1, w2 = props(doc, 'w1'), props(doc, 'w2')
+    assert np.isclose(w1['volume'], 1.) and np.isclose(w2['volume'], 1.)
+    assert np.allclose(w1['centroid'], [0.5, 0.5, 0.5])
+    assert np.allclose(w2['centroid'], [10.5, 0.5, 0.5])
+    assert np.allclose(w2['boundingboxmin'], [10., 0., 0.])
+
+
+def test_mesh_of_a_type_counts_for_its_occurrences():
+    doc = IfcxDocument({'data': [
+        node('storey', {'w1': 'w1', 'w2': 'w2'}),
+        node('type', {'Body': 'body'}),
+        node('body', attributes={MESH: CUBE}),
+        node('w1', inherits={'type': 'type'}, attributes={XFORM: {'transform': translation(0.)}}),
+        node('w2', inherits={'type': 'type'}, attributes={XFORM: {'transform': translation(10.)}}),
+    ]})
+    calc_properties.process(doc)
+    assert not props(doc, 'type')
+    assert np.allclose(props(doc, 'w2')['centroid'], [10.5, 0.5, 0.5])
+
+
+def test_only_body_meshes_are_counted():
+    doc = IfcxDocument({'data': [
+        node('storey', {'w': 'w'}),
+        node('w', {'Body': 'body', 'Basis': 'basis'}),
+        node('body', attributes={MESH: CUBE}),
+        node('basis', attributes={MESH: CUBE}),
+    ]})
+    calc_properties.process(doc)
+    assert np.isclose(props(doc, 'w')['surfacearea'], 6.)
@@ -0,0 +1,42 @@
+import numpy as np
+
+import merge_meshes
+from ifcx_document import IfcxDocument
+from merge_meshes import MESH, match, same, welded
+
+
+# in one cell of twice the tolerance, further apart than the tolerance
+POINTS = [[0.001, 0., 0.], [0.019, 0., 0.], [0.001, 0.5, 0.]]
+TRIS = [0, 1, 2]
+
+
+def test_points_sharing_a_cell_match_themselves():
+    a = np.array(POINTS)
+    assert match(a, a, 0.01).tolist() == [0, 1, 2]
+    assert welded(a, 0.01).tolist() == [0, 1, 2]
+
+
+def test_match_compares_every_point_in_the_cell():
+    a = np.array(POINTS)
+    b = np.array([[0.0185, 0., 0.], [0.0105, 0., 0.]])
+    assert match(a, b, 0.01).tolist() == [1, 0]
+
+
+def test_same_meshes_with_points_sharing_a_cell():
+    m0 = merge_meshes.canonical(POINTS, TRIS)
+    m1 = merge_meshes.canonical(np.array(POINTS)[[1, 2, 0]] + 10., [2, 0, 1])
+    m2 = merge_meshes.canonical(np.array(POINTS) * [1., 2., 1.], TRIS)
+    assert same(m0, [m1, m2], 0.01).tolist() == [True, False]
+
+
+def test_process_merges_meshes_with_points_sharing_a_cell():
+    mesh = lambda d: {'points': (np.array(POINTS) + d).tolist(), 'faceVertexIndices': TRIS}
+    doc = IfcxDocument({'data': [
+        {'path': 'root', 'children': {'a': 'a', 'b': 'b'}, 'inherits': {}, 'attributes': {}},
+        {'path': 'a', 'children': {}, 'inherits': {}, 'attributes': {MESH: mesh(0.)}},
+        {'path': 'b', 'children': {}, 'inherits': {}, 'attributes': {MESH: mesh(5.)}},
+    ]})
+    merge_meshes.process(doc, tolerance=0.01)
+    b = doc.compose('b')
+    assert b['inherits'] == {'mesh': 'a'}
+    assert MESH not in b['attributes']
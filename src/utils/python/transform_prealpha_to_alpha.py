@@ -1,11 +1,18 @@
 import functools
 import itertools
+import multiprocessing
 import operator
+import os
 import sys
 import json
 import uuid
 
+import ifcx_json
+import ifcx_stream
+from ifcx_document import IfcxDocument
 
+
+@functools.lru_cache(maxsize=None)
 def transform_iden(s):
     postfix = None
     if len(s) < 33:
@@ -21,60 +28,73 @@ def transform_iden(s):
     return str(u)
 
 
+@functools.lru_cache(maxsize=None)
+def transform_ref(v):
+    parts = v[2:-1].split("/")
+    return "/".join([transform_iden(parts[0])] + parts[1:])
+
+
+mapping = {
+    "info:id": None,
+    "outputs:surface": None,
+    "outputs:surface.connect": None,
+    "inputs:diffuseColor": "bsi:ifc:presentation:diffuseColor",
+    "inputs:opacity": "bsi:ifc:presentation:opacity",
+}
+
+
+@functools.lru_cache(maxsize=None)
+def transform_key(k, nested):
+    """
+    Returns (key, expand) for attribute key `k` with a dict value if `nested`,
+    or None if the attribute is dropped. The items of expanded values become
+    attributes of their own, with their lowercased key appended to `key`.
+    """
+    if mapping.get(k, "-") is None:
+        return
+    k = mapping.get(k, k)
+
+    expand = False
+    if k == "xformOp":
+        k = "usd::xformop"
+    else:
+        parts = k.split(":")
+        if "VisibilityAPI" in parts:
+            parts.remove("VisibilityAPI")
+
+        for i in range(len(parts) - (0 if nested else 1)):
+            parts[i] = parts[i].lower()
+
+        if parts and parts[0] == 'ifc5':
+            parts[0:1] = ['bsi', 'ifc']
+            if 'properties' in parts or 'system' in parts:
+                if 'properties' in parts:
+                    parts[parts.index('properties')] = 'prop'
+                expand = True
+
+        k = "::".join(parts)
+
+    if k.startswith("usd") and not k.startswith("usd::"):
+        k = "usd::" + k
+
+    return k, expand
+
+
 def transform_attributes(d):
-    mapping = {
-        "info:id": None,
-        "outputs:surface": None,
-        "outputs:surface.connect": None,
-        "inputs:diffuseColor": "bsi:ifc:presentation:diffuseColor",
-        "inputs:opacity": "bsi:ifc:presentation:opacity",
-    }
-
-    def transform(k, v):
-        if mapping.get(k, "-") is None:
-            return
-        k = mapping.get(k, k)
+    result = {}
+    for k, v in d.items():
+        if (t := transform_key(k, isinstance(v, dict))) is None:
+            continue
+        k, expand = t
         if k == "ref":
-            parts = v[2:-1].split("/")
-            v = "/".join([transform_iden(parts[0])] + parts[1:])
-
-        kvs = []
+            v = transform_ref(v)
 
-        if k == "xformOp":
-            k = "usd::xformop"
+        if expand and v:
+            kvs = [(f"{k}::{kk.lower()}", bool(vv) if kk.lower() == 'isexternal' else vv) for kk, vv in v.items()]
         else:
-            parts = k.split(":")
-            try:
-                parts.remove("VisibilityAPI")
-            except:
-                pass
-
-            for i in range(len(parts) - (0 if isinstance(v, dict) else 1)):
-                parts[i] = parts[i].lower()
-
-            if parts and parts[0] == 'ifc5':
-                parts[0:1] = ['bsi', 'ifc']
-                if 'properties' in parts or 'system' in parts:
-                    if 'properties' in parts:
-                        parts[parts.index('properties')] = 'prop'
-                    for kk, vv in v.items():
-                        if kk.lower() == 'isexternal':
-                            vv = bool(vv)
-                        kvs.append((parts + [kk.lower()], vv))
-            
-            if not kvs:
-                kvs.append((parts, v))
-
-        if not kvs:
-            kvs.append((k, v))
+            kvs = [(k, v)]
 
         for k, v in kvs:
-            if isinstance(k, list):
-                k = "::".join(k)
-
-            if k.startswith("usd") and not k.startswith("usd::"):
-                k = "usd::" + k
-
             if isinstance(v, dict):
                 v = transform_attributes(v)
                 if not v:
@@ -84,93 +104,146 @@ def transform_attributes(d):
                 # ? if not v:
                 # ?     continue
 
-            yield k, v
+            result[k] = v
 
-    return dict(itertools.chain.from_iterable(itertools.starmap(transform, d.items())))
+    return result
 
 
-def process():
-    model = json.load(open(sys.argv[1]))
-    originalInstanceNames = dict(map(lambda s: (s[0], s[1].split('=')[1].split('(')[0]), filter(lambda s: s[1], [(d.get('name'), d.get('attributes', {}).get('customdata', {}).get('originalStepInstance')) for d in model])))
-    def nameInherit(i, n, ref):
-        if n == 1 and ref in originalInstanceNames:
-            r = originalInstanceNames[ref]
-            return f'{r[3].lower()}{r[4:]}'
-        else:
-            return f'inh_{i}'
-    for elem in model:
-        if "disclaimer" in elem:
-            continue
+def original_instance_names(model):
+    return dict(map(lambda s: (s[0], s[1].split('=')[1].split('(')[0]), filter(lambda s: s[1], [(d.get('name'), d.get('attributes', {}).get('customdata', {}).get('originalStepInstance')) for d in model])))
 
-        if elem.get('name') is not None and elem.get('def') == 'def' and len(elem.get('inherits', ())) == 1:
-            # handle root node differently: inherit becomes named child to retain root name
-            yield {
-                "path": transform_iden(elem["name"]),
-                "children": {elem["name"]: transform_iden(elem['inherits'][0][2:-1])}
-            }
-            continue
 
-        children = list(filter(lambda c: c.get("inherits"), elem.get("children", [])))
+def name_inherit(i, n, ref, originalInstanceNames):
+    if n == 1 and ref in originalInstanceNames:
+        r = originalInstanceNames[ref]
+        return f'{r[3].lower()}{r[4:]}'
+    else:
+        return f'inh_{i}'
 
-        # Children should inherit immediately to a node in the root to flatten the exchange structure.
-        # In case of material/shader this wasn't fully compliant yet.
-        weird_children = filter(lambda c: not c.get("inherits"), elem.get("children", []))
-        weird_child_attrs = functools.reduce(
-            operator.or_,
-            (c.get("attributes") or {} for c in filter(lambda c: not c.get("inherits"), weird_children)),
-            {},
-        )
 
-        attributes = {**weird_child_attrs, **(elem.get("attributes") or {})}
-
-        if (attributes and transform_attributes(attributes)) or elem.get("inherits") or children:
-            yield {
-                "path": transform_iden(elem["name"]),
-                **(
-                    {"attributes": transform_attributes(attributes)}
-                    if attributes and transform_attributes(attributes)
-                    else {}
-                ),
-                **(
-                    {"inherits": dict((nameInherit(k, len(elem["inherits"]), v[2:-1]), transform_iden(v[2:-1])) for k, v in enumerate(elem["inherits"]))}
-                    if elem.get("inherits")
-                    else {}
-                ),
-                **(
-                    {"children": dict((d["name"], transform_iden(d["inherits"][0][2:-1])) for d in children)}
-                    if children
-                    else {}
-                ),
-            }
+def transform_element(elem, originalInstanceNames):
+    if "disclaimer" in elem:
+        return
 
+    if elem.get('name') is not None and elem.get('def') == 'def' and len(elem.get('inherits', ())) == 1:
+        # handle root node differently: inherit becomes named child to retain root name
+        yield {
+            "path": transform_iden(elem["name"]),
+            "children": {elem["name"]: transform_iden(elem['inherits'][0][2:-1])}
+        }
+        return
 
-def fold(k, vs):
-    raise NotImplementedError
+    children = list(filter(lambda c: c.get("inherits"), elem.get("children", [])))
 
+    # Children should inherit immediately to a node in the root to flatten the exchange structure.
+    # In case of material/shader this wasn't fully compliant yet.
+    weird_children = filter(lambda c: not c.get("inherits"), elem.get("children", []))
+    weird_child_attrs = functools.reduce(
+        operator.or_,
+        (c.get("attributes") or {} for c in filter(lambda c: not c.get("inherits"), weird_children)),
+        {},
+    )
 
-items = list(process())
+    attributes = transform_attributes({**weird_child_attrs, **(elem.get("attributes") or {})})
 
-if False:
-    items = list(
-        itertools.starmap(
-            fold,
-            itertools.groupby(
-                sorted(items, key=operator.attrgetter("path")),
-                key=operator.attrgetter("path"),
+    if attributes or elem.get("inherits") or children:
+        yield {
+            "path": transform_iden(elem["name"]),
+            **(
+                {"attributes": attributes}
+                if attributes
+                else {}
             ),
-        )
-    )
+            **(
+                {"inherits": dict((name_inherit(k, len(elem["inherits"]), v[2:-1], originalInstanceNames), transform_iden(v[2:-1])) for k, v in enumerate(elem["inherits"]))}
+                if elem.get("inherits")
+                else {}
+            ),
+            **(
+                {"children": dict((d["name"], transform_iden(d["inherits"][0][2:-1])) for d in children)}
+                if children
+                else {}
+            ),
+        }
+
+
+def transform_elements(elems):
+    # in worker processes, with the names passed to init_worker()
+    return [node for elem in elems for node in transform_element(elem, worker_names)]
+
+
+def init_worker(names):
+    global worker_names
+    worker_names = names
+
+
+def process(model, num_workers=None, chunk_size=1000, names=None):
+    """
+    Yields the alpha nodes of the prealpha elements in `model`, in order. With
+    `num_workers` > 1, chunks of elements are transformed in a pool of worker
+    processes. `model` can be an iterator when the original instance `names`
+    of its elements are given.
+    """
+    originalInstanceNames = original_instance_names(model) if names is None else names
+    if num_workers is None:
+        num_workers = int(os.environ.get('IFCX_TRANSFORM_WORKERS') or 1)
+    if num_workers > 1 and not (isinstance(model, list) and len(model) <= chunk_size):
+        elems = iter(model)
+        chunks = iter(lambda: list(itertools.islice(elems, chunk_size)), [])
+        with multiprocessing.Pool(num_workers, init_worker, (originalInstanceNames,)) as pool:
+            # a few chunks per worker at a time, so that an iterator is not read ahead
+            while window := list(itertools.islice(chunks, num_workers * 4)):
+                for nodes in pool.imap(transform_elements, window):
+                    yield from nodes
+    else:
+        for elem in model:
+            yield from transform_element(elem, originalInstanceNames)
 
-json.dump(
-    {
-        "header": {
-            "version": "ifcx_alpha",
-            "author": "authorname",
-            "timestamp": "time string",
-        },
-        "schemas": {},
-        "data": items,
-    },
-    open(sys.argv[2], "w"),
-    indent=2,
-)
+
+def fold(k, vs):
+    """
+    Merges the nodes `vs` for path `k` into one, like Collapse() in
+    workflows.ts: children, inherits and attributes of later nodes win.
+    """
+    node = {"path": k}
+    for key in ("attributes", "inherits", "children"):
+        merged = {}
+        for v in vs:
+            merged.update(v.get(key) or {})
+        if merged:
+            node[key] = merged
+    return node
+
+
+header = {
+    "version": "ifcx_alpha",
+    "author": "authorname",
+    "timestamp": "time string",
+}
+
+
+if __name__ == '__main__':
+    if os.environ.get('IFCX_STREAM'):
+        # a node per element, not folded, in memory for an element at a time
+        with open(sys.argv[1]) as f:
+            names = original_instance_names(ifcx_stream.read_array(f))
+        with open(sys.argv[1]) as f, open(sys.argv[2], "w") as o, ifcx_stream.Writer(o) as w:
+            w.write("header", header)
+            w.write("schemas", {})
+            for node in process(ifcx_stream.read_array(f), names=names):
+                w.node(node)
+    else:
+        doc = IfcxDocument()
+        doc.extend(process(json.load(open(sys.argv[1]))))
+
+        # one node per path, in order of first occurrence
+        items = [fold(path, doc.records(path)) for path in doc.paths()]
+
+        ifcx_json.dump(
+            {
+                "header": header,
+                "schemas": {},
+                "data": items,
+            },
+            open(sys.argv[2], "w"),
+        )
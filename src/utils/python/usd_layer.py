@@ -0,0 +1,96 @@
+import numpy as np
+
+from pxr import Sdf
+
+from ifcx_writer import usd_values
+
+SPECIFIERS = {
+    Sdf.SpecifierDef: 'def',
+    Sdf.SpecifierClass: 'class',
+    Sdf.SpecifierOver: 'over',
+}
+
+
+def single_precision(type_name):
+    # float and half scalars and Gf vectors, written at float precision
+    t = type_name.scalarType.cppTypeName
+    return t in ('float', 'GfHalf') or (t.startswith('Gf') and t[-1] in 'fh')
+
+
+def list_op_items(op):
+    # the list op statements as written in .usda, of which the last one wins
+    if op.isExplicit:
+        return list(op.explicitItems)
+    return next((list(items) for items in (op.appendedItems, op.prependedItems, op.addedItems) if items), [])
+
+
+def refs(paths):
+    return [{'ref': f'<{p}>'} for p in paths]
+
+
+def value(v, type_name, as_numpy=False):
+    """
+    An attribute value as parse_usda() returns it for its .usda text. Numeric
+    values are read through the buffer protocol and with `as_numpy` arrays
+    are returned as such.
+    """
+    if isinstance(v, bool):
+        # written as 0 and 1
+        return int(v)
+    if isinstance(v, str):
+        return v
+    if type_name.isArray and not len(v):
+        # empty arrays are [None] in the grammar
+        return [None]
+    a = np.asarray(v)
+    if a.dtype.kind not in 'biuf':
+        return list(map(str, v)) if type_name.isArray else str(v)
+    if as_numpy and a.ndim:
+        return a
+    return usd_values(a, np.float32 if single_precision(type_name) else np.float64)
+
+
+def properties(prim, as_numpy=False):
+    props = {}
+    for prop in prim.properties:
+        if isinstance(prop, Sdf.RelationshipSpec):
+            targets = list_op_items(prop.targetPathList)
+            if targets:
+                props[prop.name] = refs(targets)
+            elif not prop.custom:
+                # `custom rel` declarations are stripped from the text
+                props[prop.name] = None
+        else:
+            connections = list_op_items(prop.connectionPathList)
+            if prop.HasDefaultValue():
+                props[prop.name] = value(prop.default, prop.typeName, as_numpy)
+            elif not connections:
+                props[prop.name] = None
+            if connections:
+                props[f'{prop.name}.connect'] = refs(connections)
+    return props
+
+
+def prim_dict(prim, as_numpy=False):
+    inherits = [f'<{p}>' for p in list_op_items(prim.inheritPathList)]
+    props = properties(prim, as_numpy)
+    children = [prim_dict(ch, as_numpy) for ch in prim.nameChildren]
+    return {
+        "def": SPECIFIERS[prim.specifier],
+        "type": prim.typeName or None,
+        "name": prim.name,
+        **({"inherits": inherits} if inherits else {}),
+        **({"attributes": props} if props else {}),
+        **({"children": children} if children else {})
+    }
+
+
+def read_layer(fn, as_numpy=False):
+    """
+    Reads a USD layer in any format (.usda, .usdc) into the dict produced by
+    parse_usda() for its .usda text, by walking the prim specs of the layer.
+    """
+    layer = Sdf.Layer.FindOrOpen(fn)
+    if layer is None:
+        raise IOError(f'unable to open {fn}')
+    return {'children': [prim_dict(prim, as_numpy) for prim in layer.rootPrims]}
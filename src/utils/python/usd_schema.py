@@ -0,0 +1,54 @@
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+
+
+def build_plugin(usd_home, schema_dir='schema/ifc5', build_dir=None):
+    """
+    Returns a directory with the plugin generated by usdGenSchema from
+    schema.usd in `schema_dir`. Builds are stored in a directory per hash of
+    schema.usd, so usdGenSchema only runs when the schema changed. A build is
+    generated in a temporary directory and renamed into place once
+    usdGenSchema succeeded, which makes concurrent conversions safe.
+    """
+    schema_dir = os.path.abspath(schema_dir)
+    build_dir = os.path.abspath(build_dir or os.path.join(schema_dir, 'build'))
+
+    with open(os.path.join(schema_dir, 'schema.usd'), 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[0:16]
+
+    plugin_dir = os.path.join(build_dir, digest)
+    if os.path.exists(os.path.join(plugin_dir, 'plugInfo.json')):
+        return plugin_dir
+
+    os.makedirs(build_dir, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=build_dir, prefix=f'{digest}.')
+
+    try:
+        subprocess.check_call([rf'{usd_home}\scripts\usdGenSchema.bat', 'schema.usd', tmp], cwd=schema_dir, shell=True)
+
+        with open(os.path.join(tmp, 'plugInfo.2.json'), 'w') as g:
+            with open(os.path.join(tmp, 'plugInfo.json'), 'r') as f:
+                for i in range(3):
+                    g.write(f.readline())
+                d = json.load(f)
+                d['Plugins'][0]['LibraryPath'] = plugin_dir
+                d['Plugins'][0]['ResourcePath'] = plugin_dir
+                json.dump(d, g, indent=4)
+
+        shutil.move(os.path.join(tmp, 'plugInfo.2.json'), os.path.join(tmp, 'plugInfo.json'))
+    except BaseException:
+        # a failed build is not left to be taken for a valid one
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+    try:
+        os.rename(tmp, plugin_dir)
+    except OSError:
+        # another conversion completed the same build first
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    return plugin_dir
@@ -0,0 +1,149 @@
+import numpy as np
+
+from pxr import Usd, UsdGeom, Vt, Gf, Sdf
+
+
+class UsdWriter:
+    """
+    Authors the prims emitted by ifc4-to-usda.py on a USD stage. Prims are
+    addressed by path string, value types by their Sdf.ValueTypeNames name.
+
+    Specs are authored on the edit target layer directly, with the edits of
+    `batch_size` flushed prims grouped in a single Sdf.ChangeBlock, so the
+    stage is not recomposed after every edit. Arrays are passed to Vt as numpy
+    buffers.
+    """
+
+    def __init__(self, fn, batch_size=1000):
+        self.stage = Usd.Stage.CreateNew(fn)
+        UsdGeom.SetStageUpAxis(self.stage, UsdGeom.Tokens.z)
+        self.layer = self.stage.GetRootLayer()
+        self.batch_size = batch_size
+        self.block = None
+        self.num_flushed = 0
+        self.materials = set()
+
+    def prim(self, path):
+        if self.block is None:
+            self.block = Sdf.ChangeBlock()
+            self.block.__enter__()
+        return self.layer.GetPrimAtPath(path) or Sdf.CreatePrimInLayer(self.layer, path)
+
+    def attribute(self, path, name, type_name, custom=True, variability=Sdf.VariabilityVarying):
+        prim = self.prim(path)
+        if name in prim.attributes:
+            return prim.attributes[name]
+        return Sdf.AttributeSpec(prim, name, type_name, variability, custom)
+
+    def relationship(self, path, name, custom=True):
+        prim = self.prim(path)
+        if name in prim.relationships:
+            return prim.relationships[name]
+        return Sdf.RelationshipSpec(prim, name, custom)
+
+    def apply_api(self, path, api):
+        prim = self.prim(path)
+        schemas = prim.GetInfo('apiSchemas')
+        if api not in schemas.prependedItems:
+            schemas.prependedItems = list(schemas.prependedItems) + [api]
+            prim.SetInfo('apiSchemas', schemas)
+
+    def define_class(self, path, type_name='Xform'):
+        prim = self.prim(path)
+        prim.specifier = Sdf.SpecifierClass
+        prim.typeName = type_name
+
+    def define(self, path, type_name=None, inherits=()):
+        prim = self.prim(path)
+        prim.specifier = Sdf.SpecifierDef
+        if type_name:
+            prim.typeName = type_name
+        for ih in inherits:
+            self.add_inherit(path, ih)
+
+    def add_inherit(self, path, target):
+        self.prim(path).inheritPathList.prependedItems.append(Sdf.Path(target))
+
+    def set_attribute(self, path, name, type_name, value):
+        self.attribute(path, name, getattr(Sdf.ValueTypeNames, type_name)).default = value
+
+    def set_transform(self, path, matrix):
+        self.attribute(path, 'xformOp:transform', Sdf.ValueTypeNames.Matrix4d, custom=False).default = Gf.Matrix4d(matrix)
+        self.attribute(path, 'xformOpOrder', Sdf.ValueTypeNames.TokenArray, custom=False, variability=Sdf.VariabilityUniform).default = Vt.TokenArray(['xformOp:transform'])
+
+    def set_points_attr(self, path, points):
+        points = np.ascontiguousarray(points, dtype=np.float32).reshape((-1, 3))
+        self.attribute(path, 'points', Sdf.ValueTypeNames.Point3fArray, custom=False).default = Vt.Vec3fArray.FromNumpy(points)
+
+    def set_int_array(self, path, name, values):
+        values = np.ascontiguousarray(values, dtype=np.int32).ravel()
+        self.attribute(path, name, Sdf.ValueTypeNames.IntArray, custom=False).default = Vt.IntArray.FromNumpy(values)
+
+    def set_mesh(self, path, vs, idxs):
+        self.set_points_attr(path, vs)
+        self.set_int_array(path, 'faceVertexIndices', idxs)
+        self.set_int_array(path, 'faceVertexCounts', np.full(np.size(idxs) // 3, 3))
+
+    def set_curves(self, path, points, counts):
+        self.set_points_attr(path, points)
+        self.set_int_array(path, 'curveVertexCounts', counts)
+        self.attribute(path, 'type', Sdf.ValueTypeNames.Token, custom=False, variability=Sdf.VariabilityUniform).default = UsdGeom.Tokens.linear
+        self.attribute(path, 'widths', Sdf.ValueTypeNames.FloatArray, custom=False).default = Vt.FloatArray.FromNumpy(np.full(len(points), 0.01, dtype=np.float32))
+
+    def set_points(self, path, points):
+        self.set_points_attr(path, points)
+
+    def set_invisible(self, path):
+        self.attribute(path, 'visibility', Sdf.ValueTypeNames.Token, custom=False).default = UsdGeom.Tokens.invisible
+
+    def add_targets(self, path, name, targets, api=None):
+        if api:
+            self.apply_api(path, api)
+        items = self.relationship(path, name, custom=not api).targetPathList.prependedItems
+        for t in map(Sdf.Path, targets):
+            # like Usd.Relationship.AddTarget(), moves existing targets to the back
+            if t in items:
+                items.remove(t)
+            items.append(t)
+
+    def define_material(self, name, color, opacity):
+        material = f'/{name}Material'
+        self.define(material, 'Material')
+        self.define(f'{material}/Shader', 'Shader')
+        self.attribute(f'{material}/Shader', 'info:id', Sdf.ValueTypeNames.Token, custom=False, variability=Sdf.VariabilityUniform).default = 'UsdPreviewSurface'
+        self.attribute(f'{material}/Shader', 'inputs:diffuseColor', Sdf.ValueTypeNames.Color3f, custom=False).default = Gf.Vec3f(*color)
+        self.attribute(f'{material}/Shader', 'inputs:opacity', Sdf.ValueTypeNames.Float, custom=False).default = opacity
+        self.attribute(f'{material}/Shader', 'outputs:surface', Sdf.ValueTypeNames.Token, custom=False)
+        surface = self.attribute(material, 'outputs:surface', Sdf.ValueTypeNames.Token, custom=False)
+        surface.connectionPathList.explicitItems = [Sdf.Path(f'{material}/Shader.outputs:surface')]
+
+    def bind_material(self, path, name, color, opacity):
+        # one material per name, shared by all prims it is bound to
+        if name not in self.materials:
+            self.define_material(name, color, opacity)
+            self.materials.add(name)
+        self.apply_api(path, 'MaterialBindingAPI')
+        self.relationship(path, 'material:binding', custom=False).targetPathList.explicitItems = [Sdf.Path(f'/{name}Material')]
+
+    def flush(self, path=None):
+        # prims are authored on the layer directly, flushing only ends the
+        # change block once enough prims have been authored
+        self.num_flushed += 1
+        if path is None or self.num_flushed >= self.batch_size:
+            self.end_block()
+
+    def end_block(self):
+        if self.block is not None:
+            self.block.__exit__(None, None, None)
+            self.block = None
+            self.num_flushed = 0
+
+    def sublayer(self, fn):
+        self.end_block()
+        self.layer = Sdf.Layer.CreateNew(fn)
+        self.stage.GetRootLayer().subLayerPaths.append(self.layer.identifier)
+        self.stage.SetEditTarget(self.layer)
+
+    def save(self):
+        self.end_block()
+        self.layer.Save()
@@ -1,11 +1,15 @@
 import collections
 import functools
 import operator
+import os
 import re
 import sys
 from lark import Lark, Transformer, v_args, Tree
 import json
 
+import ifcx_json
+import usda_parser
+
 usda_grammar = r"""
     start: meta? statement*
 
@@ -120,13 +124,27 @@ class USDAtoJSON(Transformer):
         }
 
 def parse_usda_to_dict(usda_content):
+    if os.environ.get('USDA_PARSER') != 'earley':
+        # same result, without going through Earley
+        return usda_parser.parse_usda(usda_content)
     parse_tree = parser.parse(re.sub(r'custom rel [\w:]+', '', usda_content))
     json_data = USDAtoJSON().transform(parse_tree)
     return json_data
 
-usda_content = open(sys.argv[1]).read()
+def read_usd_to_dict(fn):
+    # layers are read natively when pxr is available, which also covers
+    # binary .usdc, unless a text parser is requested in USDA_PARSER
+    if os.environ.get('USDA_PARSER') not in ('text', 'earley'):
+        try:
+            import usd_layer
+        except ImportError:
+            if not fn.endswith('.usda'):
+                raise
+        else:
+            return usd_layer.read_layer(fn)
+    return parse_usda_to_dict(open(fn).read())
 
-di = parse_usda_to_dict(usda_content)
+di = read_usd_to_dict(sys.argv[1])
 
 ignored_attributes = {
     'faceVertexCounts': lambda attrs: all(i == 3 for i in attrs['faceVertexCounts']),
@@ -200,8 +218,6 @@ for node in di['children']:
 
 di = [c for c in di['children'] if id(c) not in empties] + overs
 
-s = json.dumps(di, indent=1)
-s = re.sub('\n\s+([\-\+\d\.e]+|\])(,?)(?=\n)', '\\1\\2', s)
-
 with open(sys.argv[2], 'w') as f:
-    print(s, file=f)
+    ifcx_json.dump(di, f, indent=1, compact=True)
+    f.write('\n')
@@ -0,0 +1,257 @@
+import functools
+import json
+import operator
+import re
+
+import numpy as np
+
+# tokens of the grammar in usda-to-json.py
+TOKEN = re.compile(r'''
+    (?P<ws>(?:\s+|\#.+)+)
+  | (?P<string>"[^"\n]*")
+  | (?P<ref><[^>]+>)
+  | (?P<number>-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)
+  | (?P<name>[A-Za-z_][A-Za-z_:\.\d]*)
+  | (?P<empty>\[\])
+  | (?P<punct>[\[\]\(\)\{\}=,])
+''', re.VERBOSE)
+
+WS = re.compile(r'(?:\s+|\#.+)+')
+
+# prefix of an array that only contains numbers
+NUMERIC_ARRAY = re.compile(r'[\[\(][\d\s\.\-\+eE,\[\]\(\)]*')
+TRAILING_COMMA = re.compile(r',(\s*)\]')
+EMPTY_ARRAY = re.compile(r'\[\s*\]')
+BRACKETS = str.maketrans('()', '[]')
+OPEN, CLOSE = np.frombuffer(b'[(', np.uint8), np.frombuffer(b'])', np.uint8)
+
+DEFTYPES = ('def', 'class', 'over')
+KEYWORDS = ('prepend', 'custom', 'uniform')
+
+
+class ParseError(ValueError):
+    pass
+
+
+class Parser:
+    """
+    Recursive descent parser for the subset of .usda parsed by usda-to-json.py,
+    producing the same dict as its Lark grammar and transformer. Arrays of
+    numbers are matched as a whole and converted by json (or numpy, with
+    `as_numpy`) rather than token by token.
+    """
+
+    def __init__(self, text, as_numpy=False):
+        self.text = text
+        self.pos = 0
+        self.as_numpy = as_numpy
+        self.tok = self.advance()
+
+    def advance(self):
+        m = TOKEN.match(self.text, self.pos)
+        while m and m.lastgroup == 'ws':
+            m = TOKEN.match(self.text, m.end())
+        if m is None:
+            if (m := WS.match(self.text, self.pos)):
+                self.pos = m.end()
+            if self.pos < len(self.text):
+                raise ParseError(f'unexpected character at {self.pos}: {self.text[self.pos:self.pos + 20]!r}')
+            self.tok = None
+            return None
+        self.start = m.start()
+        self.pos = m.end()
+        self.tok = (m.lastgroup, m.group())
+        return self.tok
+
+    def peek(self, n):
+        # the kinds and values of the next `n` tokens, without consuming them
+        state = self.pos, self.tok, getattr(self, 'start', 0)
+        toks = [self.tok]
+        for _ in range(n - 1):
+            toks.append(self.advance() if toks[-1] else None)
+        self.pos, self.tok, self.start = state
+        return toks
+
+    def expect(self, value):
+        if self.tok is None or self.tok[1] != value:
+            raise ParseError(f'expected {value!r} at {self.pos}, got {self.tok!r}')
+        self.advance()
+
+    def is_punct(self, value):
+        return self.tok is not None and self.tok[0] in ('punct', 'empty') and self.tok[1] == value
+
+    def parse(self):
+        children = []
+        if self.is_punct('('):
+            self.meta()
+        while self.tok is not None:
+            if d := self.statement():
+                children.append(d)
+        return {'children': children}
+
+    def meta(self):
+        self.expect('(')
+        while not self.is_punct(')'):
+            if self.tok is None:
+                raise ParseError('unterminated layer metadata')
+            if self.tok[0] == 'string':
+                self.advance()
+            else:
+                self.advance()
+                self.expect('=')
+                self.value()
+        self.advance()
+
+    def statement(self):
+        if self.tok[0] == 'name' and self.tok[1] in DEFTYPES:
+            nxt = self.peek(3)
+            if nxt[1] and (nxt[1][0] == 'string' or (nxt[1][0] == 'name' and nxt[2] and nxt[2][0] == 'string')):
+                return self.block()
+        return self.assignment()
+
+    def statements(self, close):
+        items = []
+        while not self.is_punct(close):
+            if self.tok is None:
+                raise ParseError(f'expected {close!r}')
+            items.append(self.statement())
+        self.advance()
+        return items
+
+    def block(self):
+        deftype = self.tok[1]
+        type_name = None
+        if self.advance()[0] == 'name':
+            type_name = self.tok[1]
+            self.advance()
+        name = self.tok[1].strip('"')
+        self.advance()
+
+        inherits = []
+        if self.is_punct('('):
+            self.advance()
+            metadef = self.statements(')')
+            if metadef:
+                vs = functools.reduce(operator.or_, metadef).get('inherits')
+                if vs:
+                    if isinstance(vs, dict):
+                        vs = [vs]
+                    inherits = [next(iter(v.values())) for v in vs]
+
+        self.expect('{')
+        scope = self.statements('}')
+        subs = [d for d in scope if len(d) > 1]
+        props = functools.reduce(dict.__or__, [d for d in scope if len(d) == 1], {}) if scope else []
+
+        return {
+            "def": deftype,
+            "type": type_name,
+            "name": name,
+            **({"inherits": inherits} if inherits else {}),
+            **({"attributes": props} if props else {}),
+            **({"children": subs} if subs else {})
+        }
+
+    def assignment(self):
+        # optional keywords are only keywords when a type and name follow,
+        # otherwise they are the type, as in `prepend inherits = </...>`
+        for kw in KEYWORDS:
+            if self.tok and self.tok == ('name', kw):
+                nxt = [t for t in self.peek(4)[1:] if t is None or t[0] != 'empty']
+                if len(nxt) >= 2 and all(t and t[0] == 'name' for t in nxt[0:2]):
+                    self.advance()
+        if self.tok is None or self.tok[0] != 'name':
+            raise ParseError(f'expected a type at {self.pos}, got {self.tok!r}')
+        self.advance()
+        if self.tok and self.tok[0] == 'empty':
+            self.advance()
+        if self.tok is None or self.tok[0] != 'name':
+            raise ParseError(f'expected a name at {self.pos}, got {self.tok!r}')
+        key = self.tok[1]
+        self.advance()
+        value = None
+        if self.is_punct('='):
+            self.advance()
+            value = self.value()
+        if isinstance(value, dict) and "ref" in value:
+            # references are always plural in USD
+            value = [value]
+        return {key: value}
+
+    def value(self):
+        kind, v = self.tok
+        if kind == 'string':
+            self.advance()
+            return v.strip('"')
+        elif kind == 'number':
+            self.advance()
+            return float(v) if '.' in v or 'e' in v or 'E' in v else int(v)
+        elif kind == 'ref':
+            self.advance()
+            return {'ref': v}
+        elif kind == 'name' and v in ('true', 'false'):
+            self.advance()
+            return v == 'true'
+        elif kind == 'empty':
+            self.advance()
+            return [None]
+        elif kind == 'punct' and v in '[(':
+            numbers = self.numeric_array()
+            if numbers is not None:
+                return numbers
+            close = ']' if v == '[' else ')'
+            self.advance()
+            items = []
+            while not self.is_punct(close):
+                items.append(self.value())
+                if self.is_punct(','):
+                    self.advance()
+                elif not self.is_punct(close):
+                    raise ParseError(f'expected , or {close} at {self.pos}')
+            self.advance()
+            return items or [None]
+        raise ParseError(f'unexpected {v!r} at {self.pos}')
+
+    def numeric_array(self):
+        m = NUMERIC_ARRAY.match(self.text, self.start)
+        span = m.group().encode('ascii')
+        b = np.frombuffer(span, np.uint8)
+        opens = np.isin(b, OPEN)
+        depth = np.cumsum(opens, dtype=np.int64) - np.cumsum(np.isin(b, CLOSE), dtype=np.int64)
+        closed = np.flatnonzero(depth == 0)
+        if not len(closed):
+            return None
+        end = int(closed[0]) + 1
+        text = span[:end].decode('ascii').translate(BRACKETS)
+        text = TRAILING_COMMA.sub(r'\1]', text)
+        if EMPTY_ARRAY.search(text) or not re.search(r'\d', text):
+            # empty arrays are [None] in the grammar
+            return None
+
+        try:
+            if self.as_numpy:
+                value = self.to_numpy(text, depth[:end][opens[:end]])
+            else:
+                value = json.loads(text)
+        except ValueError:
+            return None
+
+        self.pos = self.start + end
+        self.advance()
+        return value
+
+    @staticmethod
+    def to_numpy(text, open_depths):
+        flat = text.replace('[', ' ').replace(']', ' ').split(',')
+        dtype = float if any(c in text for c in '.eE') else int
+        counts = np.bincount(open_depths)
+        shape = [int(counts[k + 1] // counts[k]) for k in range(1, len(counts) - 1)]
+        return np.array(flat, dtype=float).astype(dtype).reshape(shape + [-1])
+
+
+def parse_usda(usda_content, as_numpy=False):
+    """
+    Parses .usda text into the dict produced by parse_usda_to_dict() in
+    usda-to-json.py. With `as_numpy`, numeric arrays are numpy arrays.
+    """
+    return Parser(re.sub(r'custom rel [\w:]+', '', usda_content), as_numpy).parse()